@@ -1,3 +1,4 @@
+import logging
 from datetime import datetime
 import numpy as np
 from pandas.core.interchange.dataframe_protocol import DataFrame
@@ -9,20 +10,22 @@ import matplotlib.pyplot as plt
 from src.ai_module.ensemble import EnsembleModel
 from src.common.config import DatasetConfig
 from src.models.firewall_rule import FirewallRuleBaseModel
-from src.ai_module.utils.new_dataset import normalize
+from src.ai_module.utils.rule_index import CriticalRuleIndex, FirewallRuleIndex
+from src.ai_module.utils.rule_compaction import compact_rules
 from src.models.enums import Action
 from src.services.persistence import VersionedObjectManager
 from src.models.critical_rule import CriticalRuleOutModel, CriticalRule, GetAllCriticalRules
 from src.models.firewall_rule import FirewallRule, FirewallRuleOutModel, GetAllFirewallRules, FirewallRuleCreateModel
 from src.services.database import get_session, DBSessionManager
 from src.services.executor import SSHExecutor
-from src.services.firewall import IPTablesWriter
-from src.common.config import ConfigurationManager
+from src.services.firewall import IPTablesWriter, NFTablesWriter, FirewallWriterGroup
+from src.common.config import ConfigurationManager, FirewallBackendOption
 from src.services.database import InjectedSession
 from src.models.variable import ConfusionMatrixInfo, Time
 
 
 class EnsembleManager(VersionedObjectManager[EnsembleModel]):
+    _prediction_batch_size = 50_000
 
     def __init__(self) -> None:
         server_config = ConfigurationManager().get_server_config()
@@ -34,8 +37,17 @@ class EnsembleManager(VersionedObjectManager[EnsembleModel]):
         self._model_result_info : ConfusionMatrixInfo
         self._attack_type_map: list[str] = self.get_mapping()
         self._attack_per_minute: dict[(int, int), int] = {}
-        executor = SSHExecutor(server_config.executor_credentials.ssh_host,server_config.executor_credentials.ssh_user,server_config.executor_credentials.ssh_key_path)
-        self.firewall_writer = IPTablesWriter(executor, server_config.firewall_info.chain, server_config.firewall_info.table)
+        writer_cls = NFTablesWriter \
+            if server_config.firewall_info.backend == FirewallBackendOption.NFTABLES else IPTablesWriter
+        self.firewall_writer = FirewallWriterGroup({
+            executor_config.ssh_host: writer_cls(
+                SSHExecutor(executor_config.ssh_host, executor_config.ssh_user, executor_config.ssh_key_path,
+                            control_persist_seconds=executor_config.control_persist_seconds,
+                            max_concurrent_commands=executor_config.max_concurrent_commands,
+                            timeout_seconds=executor_config.timeout_seconds),
+                server_config.firewall_info.chain, server_config.firewall_info.table)
+            for executor_config in server_config.all_executor_credentials
+        }, timeout_seconds=server_config.firewall_info.host_timeout_seconds)
         super().__init__(cls=EnsembleModel)
 
     def get_mapping(self):
@@ -63,6 +75,13 @@ class EnsembleManager(VersionedObjectManager[EnsembleModel]):
             self.load_new_version(new_ensemble)
             self._reset_cache()
 
+    def continue_loaded_ensemble(self, df_training: DataFrame):
+        with self.load_guard():
+            new_ensemble = EnsembleModel()
+            new_ensemble.continue_training(self.get_loaded_version(), df_training)
+            self.load_new_version(new_ensemble)
+            self._reset_cache()
+
     def evaluate_loaded_ensemble(self, df_test: DataFrame) -> ConfusionMatrixInfo:
         if not self.already_evaluated:
             with self.load_guard():
@@ -88,125 +107,81 @@ class EnsembleManager(VersionedObjectManager[EnsembleModel]):
 
         return self._model_result_info
     
-    def check_critical_rule_collision(self, rule, protocol_map):
-        session: Session = DBSessionManager().get_session()
-        dst_port=int(rule[0]),
-        protocol=protocol_map[int(rule[1])]
-        min_fl_byt_s=rule[2],
-        max_fl_byt_s=rule[2] * 1.05,
-        min_fl_pkt_s=rule[3] * 0.95,
-        max_fl_pkt_s=rule[3] * 1.05,
-        min_tot_fw_pk=int(rule[4] * 0.95),
-        max_tot_fw_pk=int(rule[4] * 1.05),
-        min_tot_bw_pk=int(rule[5] * 0.95),
-        max_tot_bw_pk=int(rule[5] * 1.05),
-        crs: list[CriticalRuleOutModel] = (session.query(CriticalRule).all())
-        for critical_rule in crs:
-            aux = 0
-            if critical_rule.protocol != None:
-                if critical_rule.protocol != protocol:
-                    continue
-            else:
-                aux +=1
-            if critical_rule.dst_port != None:
-                if critical_rule.dst_port != dst_port:
-                    continue
-            else:
-                aux +=1
-            if (critical_rule.min_fl_byt_s != None and critical_rule.max_fl_byt_s != None):
-                if ((min_fl_byt_s > critical_rule.max_fl_byt_s) or (max_fl_byt_s < critical_rule.min_fl_byt_s)):
-                    continue
-            else:
-                aux +=1
-            if (critical_rule.min_fl_pkt_s != None and critical_rule.max_fl_pkt_s != None):
-                if ((min_fl_pkt_s > critical_rule.max_fl_pkt_s) or (max_fl_pkt_s < critical_rule.min_fl_pkt_s)):
-                    continue
-            else:
-                aux +=1
-            if (critical_rule.min_tot_fw_pk != None and critical_rule.max_tot_fw_pk != None):
-                if ((min_tot_fw_pk > critical_rule.max_tot_fw_pk) or (max_tot_fw_pk < critical_rule.min_tot_fw_pk)):
-                    continue
-            else:
-                aux +=1
-            if (critical_rule.min_tot_bw_pk != None and critical_rule.max_tot_bw_pk != None):
-                if ((min_tot_bw_pk > critical_rule.max_tot_bw_pk) or (max_tot_bw_pk < critical_rule.min_tot_bw_pk)):
-                    continue
-            else:
-                aux +=1
-            if aux == 6:
-                continue
-            return True
-        return False
+    def check_critical_rule_collision(self, rule: FirewallRule, critical_rule_index: CriticalRuleIndex) -> bool:
+        return critical_rule_index.collides(rule)
     
-    def check_rule_collision(self, rule, protocol_map):
-        session: InjectedSession = DBSessionManager().get_session()
-        dst_port=int(rule[0]),
-        protocol=protocol_map[int(rule[1])]
-        fl_byt_s=rule[2],
-        fl_pkt_s=rule[3] * 0.95,
-        tot_fw_pk=int(rule[4] * 0.95),
-        tot_bw_pk=int(rule[5] * 0.95),
-        total_rows = session.query(FirewallRule).count()
-        fwrs: list[FirewallRuleOutModel] = (session.query(FirewallRule).all())
-        
-        firewall_rules = GetAllFirewallRules(data=fwrs, total=total_rows)
-        for firewall_rule in firewall_rules.data:
-            if not (dst_port == firewall_rule.dst_port):
-                continue
-            if not (protocol == firewall_rule.protocol):
-                continue
-            if not ((abs(fl_byt_s - firewall_rule.max_fl_byt_s) - abs(fl_byt_s - firewall_rule.min_fl_byt_s)) < 0.2 * (firewall_rule.max_fl_byt_s - firewall_rule.min_fl_byt_s)):
-                continue
-            if not ((abs(fl_pkt_s - firewall_rule.max_fl_pkt_s) - abs(fl_pkt_s - firewall_rule.min_fl_pkt_s)) < 0.2 * (firewall_rule.max_fl_pkt_s - firewall_rule.min_fl_pkt_s)):
-                continue
-            if not ((abs(tot_fw_pk - firewall_rule.max_tot_fw_pk) - abs(tot_fw_pk - firewall_rule.min_tot_fw_pk)) < 0.2 * (firewall_rule.max_tot_fw_pk - firewall_rule.min_tot_fw_pk)):
-                continue
-            if not ((abs(tot_bw_pk - firewall_rule.max_tot_bw_pk) - abs(tot_bw_pk - firewall_rule.min_tot_bw_pk)) < 0.2 * (firewall_rule.max_tot_bw_pk - firewall_rule.min_tot_bw_pk)):
-                continue   
-            return True            
-        return False
+    def check_rule_collision(self, rules: list[tuple], protocol_map: list[str],
+                             firewall_rule_index: FirewallRuleIndex) -> np.ndarray:
+        values = np.array([(rule[2], rule[3] * 0.95, int(rule[4] * 0.95), int(rule[5] * 0.95)) for rule in rules],
+                          dtype=float)
+        return firewall_rule_index.find_duplicates(
+            dst_ports=[int(rule[0]) for rule in rules],
+            protocols=[protocol_map[int(rule[1])] for rule in rules],
+            values=values)
     
-    def save_rules_in_db(self, rules: list[FirewallRuleCreateModel]):
-        session = DBSessionManager().get_session()
-        for rule in rules:
-            CriticalRule.create_from(create_model=rule).save(session)
+    def sync_firewall_rules(self):
+        with DBSessionManager().get_session() as session:
+            rules = session.query(FirewallRule).all()
+        adds, deletes = self.firewall_writer.sync_rules(rules)
+        logging.info(f"[{self.__class__.__name__}] firewall synced with database: {adds} rules added, "
+                     f"{deletes} rules deleted")
+
+    def save_rules_in_db(self, rules: list[FirewallRuleCreateModel]) -> list[FirewallRule]:
+        # returns the saved rules with their ids. Rules that were already in the table are not saved again
+        with DBSessionManager().get_session() as session:
+            return FirewallRule.get_by_ids(session, FirewallRule.bulk_insert(session, rules))
+
+    def _update_attack_counters(self, attack_labels: np.ndarray, attack_ports: pd.Series):
+        for label, n in zip(*np.unique(attack_labels, return_counts=True)):
+            self._counter_attacktype[label] += int(n)
+        for port, n in attack_ports.astype(int).astype(str).value_counts().items():
+            self._counter_port[port] = self._counter_port.get(port, 0) + int(n)
+        now = datetime.now()
+        key = (now.hour, now.minute)
+        self._attack_per_minute[key] = self._attack_per_minute.get(key, 0) + len(attack_labels)
+
+    def _compact_rules(self, rules: list[FirewallRule]) -> list[tuple[FirewallRule, list[int]]]:
+        compaction_config = ConfigurationManager().get_server_config().ai_module.rule_compaction
+        if not compaction_config.enable:
+            return [(rule, [i]) for i, rule in enumerate(rules)]
+        compacted = compact_rules(rules, max_widening=compaction_config.max_widening)
+        logging.info(f"[{self.__class__.__name__}] {len(rules)} new rules compacted into {len(compacted)}")
+        return compacted
 
     def create_rules(self, df: pd.DataFrame, config : DatasetConfig):
         protocol_map = config.protocol
-        session = DBSessionManager().get_session()
         ensemble : EnsembleModel = self.get_loaded_version()
         df = ensemble.filter_col(df)
-        normalized_df = normalize(df.copy())
+        features = df.drop(['Label'], axis=1) if 'Label' in df.columns else df
         set_rules = set()
         must_include_columns = [col.name for col in config.columns if col.must_include]
-        if 'Label' in normalized_df.columns:
-            normalized_df = normalized_df.drop(['Label'], axis=1)
-        count = 2000
-        with tqdm(total= len(normalized_df)) as pbar:
-            for index, row in normalized_df.iterrows():
-                original_row : pd.Series = df.loc[index]
-                label = ensemble.predict(row.to_frame().T)
-                if label[0] != 0:
-                    rule = tuple(original_row[must_include_columns].tolist()) + (Action.BLOCK,)
-                    set_rules.add(rule)
-                    self._counter_attacktype[label[0]] += 1
-                    if str(rule[0]) in self._counter_port:
-                        self._counter_port[str(rule[0])] += 1
-                    else:
-                        self._counter_port[str(rule[0])] = 1
-                    hour=datetime.now().hour,
-                    minute=datetime.now().minute
-                    if (hour,minute) in self._attack_per_minute:
-                        self._attack_per_minute[(hour,minute)] += 1
-                    else:
-                        self._attack_per_minute[(hour,minute)] = 1
-                pbar.update(1)
-                count -= 1
-                if count <= 0: 
-                    break
-        rules : list[FirewallRule] = []
-        for rule in set_rules:
-            firewall_rule = FirewallRule(
+        # sessions are only held while querying, so the prediction below does not keep a pooled connection busy
+        with DBSessionManager().get_session() as session:
+            critical_rule_index = CriticalRuleIndex.from_session(session)
+        with tqdm(total= len(features)) as pbar:
+            for start in range(0, len(features), self._prediction_batch_size):
+                batch = features.iloc[start:start + self._prediction_batch_size]
+                labels = np.asarray(ensemble.predict(batch))
+                is_attack = labels != 0
+                pbar.update(len(batch))
+                if not is_attack.any():
+                    continue
+                attacks: pd.DataFrame = df.iloc[start:start + self._prediction_batch_size][is_attack]
+                set_rules.update(
+                    row + (Action.BLOCK,)
+                    for row in attacks[must_include_columns].drop_duplicates().itertuples(index=False, name=None))
+                self._update_attack_counters(labels[is_attack], attacks[must_include_columns[0]])
+        candidate_rules = list(set_rules)
+        with DBSessionManager().get_session() as session:
+            # only the rules sharing a port and protocol with a candidate can be duplicates of it
+            firewall_rule_index = FirewallRuleIndex.from_session(
+                session, keys=((int(rule[0]), protocol_map[int(rule[1])]) for rule in candidate_rules))
+        is_duplicate = self.check_rule_collision(candidate_rules, protocol_map, firewall_rule_index)
+        new_rules : list[FirewallRule] = []
+        for rule, duplicate in zip(candidate_rules, is_duplicate):
+            if duplicate:
+                continue
+            new_rules.append(FirewallRule(
                 dst_port=int(rule[0]),
                 protocol=protocol_map[int(rule[1])],
                 min_fl_byt_s=rule[2] * 0.95,
@@ -218,10 +193,19 @@ class EnsembleManager(VersionedObjectManager[EnsembleModel]):
                 min_tot_bw_pk=int(rule[5] * 0.95),
                 max_tot_bw_pk=int(rule[5] * 1.05),
                 action=rule[6]
-            )
-            if not self.check_critical_rule_collision(rule, protocol_map) and not self.check_rule_collision(rule, protocol_map):
+            ))
+        rules : list[FirewallRule] = []
+        for firewall_rule, members in self._compact_rules(new_rules):
+            if not self.check_critical_rule_collision(firewall_rule, critical_rule_index):
+                # rules reach the firewall through sync_firewall_rules, which runs periodically
                 rules.append(firewall_rule)
-                #self.rules.append(firewall_rule)
-                #self.firewall_writer.append_rule(firewall_rule)
-            
-        FirewallRule.bulk_create(session=session,iterable=rules)
+            elif len(members) > 1:
+                # a merged rule may reach a critical rule none of its members reached
+                rules += [new_rules[i] for i in members
+                          if not self.check_critical_rule_collision(new_rules[i], critical_rule_index)]
+
+        with DBSessionManager().get_session() as session:
+            # rules already in the table are skipped by the database, through their fingerprint
+            inserted_ids = FirewallRule.bulk_insert(session, rules)
+        logging.info(f"[{self.__class__.__name__}] {len(inserted_ids)} firewall rules created "
+                     f"({len(rules) - len(inserted_ids)} already existed)")
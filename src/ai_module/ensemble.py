@@ -1,12 +1,19 @@
+from __future__ import annotations
+
+import copy
 import pickle
+from datetime import datetime
 from threading import Lock
 from typing import Any
 
-from pandas import DataFrame, Series
+from numpy import ndarray
+from pandas import DataFrame, concat
 from sklearn.ensemble import VotingClassifier
 from sklearn.metrics import classification_report, confusion_matrix
+from sklearn.preprocessing import MinMaxScaler
 
-from src.ai_module.utils.estimator import create_ensamble
+from src.ai_module.utils.estimator import create_ensamble, continue_ensamble
+from src.ai_module.utils.new_dataset import normalize, StratifiedReservoirSampler
 from src.common.config import ConfigurationManager
 from src.common.persistence import PersistableObject
 
@@ -18,41 +25,105 @@ class EnsembleModel(PersistableObject):
         self._lock = Lock()
         self._ensamble_is_trained: bool = False
         self._columns: list[str] | None = None
+        self._scaler: MinMaxScaler | None = None
+        self._trained_at: datetime | None = None
+        # sample of every class the model was trained on, replayed when training continues
+        self._replay: StratifiedReservoirSampler | None = None
 
     @property
     def columns(self) -> list[str] | None:
         return self._columns
 
+    @property
+    def scaler(self) -> MinMaxScaler | None:
+        return self._scaler
+
+    @property
+    def trained_at(self) -> datetime | None:
+        return self._trained_at
+
     def _load(self, model_bytes: bytes) -> None:
         with self._lock:
-            self._ensemble_model, self._columns = pickle.loads(model_bytes)
+            state = pickle.loads(model_bytes)
+            # older savefiles hold fewer fields: the model and the columns are always present
+            self._ensemble_model, self._columns = state[:2]
+            self._scaler = state[2] if len(state) > 2 else None
+            self._trained_at = state[3] if len(state) > 3 else None
+            self._replay = state[4] if len(state) > 4 else None
+            self._ensamble_is_trained = True
 
     def _dump(self) -> bytes:
         with self._lock:
             if self._ensemble_model is None:
                 raise RuntimeError()
-            return pickle.dumps([self._ensemble_model, self._columns])
+            return pickle.dumps(
+                [self._ensemble_model, self._columns, self._scaler, self._trained_at, self._replay])
+
+    def _scale(self, x: DataFrame) -> DataFrame:
+        if self._scaler is None:
+            return normalize(x.copy())
+        scaled = self._scaler.transform(x[self._scaler.feature_names_in_])
+        return DataFrame(scaled, columns=self._scaler.feature_names_in_, index=x.index)
 
     def train(self, df_training: DataFrame):
         with self._lock:
-            self._ensemble_model = create_ensamble(models_config=self._models_config, df=df_training)
+            trained_at = datetime.now()
             x_train = df_training.drop('Label', axis=1)
             y_train = df_training['Label']
+            self._scaler = MinMaxScaler().fit(x_train)
+            x_train = self._scale(x_train)
+            self._ensemble_model = create_ensamble(
+                models_config=self._models_config, df=x_train.assign(Label=y_train))
             self._ensemble_model.fit(x_train, y_train)
             self._columns = df_training.columns.to_list()
+            self._replay = self._create_replay()
+            self._replay.update(df_training)
+            self._trained_at = trained_at
+            self._ensamble_is_trained = True
+
+    @staticmethod
+    def _create_replay() -> StratifiedReservoirSampler:
+        replay_sample_size = ConfigurationManager().get_server_config().ai_module.incremental_training \
+            .replay_sample_size
+        return StratifiedReservoirSampler(replay_sample_size, ConfigurationManager().get_dataset_config().num_classes)
+
+    def continue_training(self, previous: EnsembleModel, df_training: DataFrame):
+        """
+        Trains on top of a previous version: hyperparameters, columns and scaler are reused, so `df_training` only
+        needs to hold the data gathered since, whatever classes it holds. It is trained on together with the replay
+        sample of the previous version: boosted estimators continue from the previous trees, and the others are
+        refit on both. Raises ValueError when the previous version has no replay sample, as older savefiles do.
+        """
+        if not previous._ensamble_is_trained:
+            raise RuntimeError()
+        if previous._replay is None:
+            raise ValueError("the loaded ensemble has no replay sample of its training data")
+        with self._lock, previous._lock:
+            trained_at = datetime.now()
+            self._scaler = previous._scaler
+            self._columns = previous._columns
+            df_training = df_training[self._columns]
+            df_combined = concat([df_training, previous._replay.rows()[self._columns]])
+            x_train = self._scale(df_combined.drop('Label', axis=1))
+            self._ensemble_model = continue_ensamble(
+                previous._ensemble_model, x_train.assign(Label=df_combined['Label']))
+            self._replay = copy.deepcopy(previous._replay)
+            self._replay.update(df_training)
+            self._trained_at = trained_at
             self._ensamble_is_trained = True
 
-    def predict(self, row: Series):
+    def predict(self, x: DataFrame) -> ndarray:
         if not self._ensamble_is_trained:
             raise RuntimeError()
+        x = self._scale(x)
         with self._lock:
-            return self._ensemble_model.predict(row)
+            return self._ensemble_model.predict(x)
 
     def evaluate(self, df_test: DataFrame) -> tuple[str | dict, Any]:
         if not self._ensamble_is_trained:
             raise RuntimeError()
         with self._lock:
-            x_test = df_test.drop('Label', axis=1)
+            x_test = self._scale(df_test.drop('Label', axis=1))
             y_test = df_test['Label']
             y_pred = self._ensemble_model.predict(x_test)
             return (
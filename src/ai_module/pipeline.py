@@ -1,34 +1,75 @@
+import logging
+
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
-from src.ai_module.utils.new_dataset import read_and_prepare_data, normalize, filter_col, \
-    filter_outliers_zscore
+from src.ai_module.ensemble import EnsembleModel
+from src.ai_module.utils.new_dataset import read_and_prepare_data, normalize, filter_col, filter_outliers_zscore
 from src.ai_module.ensamble_manager import EnsembleManager
 from src.common.config import ConfigurationManager
 
 
-def train_pipeline():
+def train_pipeline(full_training: bool = False):
     # get configuration files
     server_config = ConfigurationManager().get_server_config()
+    incremental_config = server_config.ai_module.incremental_training
+    em = EnsembleManager()
+    loaded_ensemble: EnsembleModel | None = em.get_loaded_version()
+    if (incremental_config.enable and not full_training
+            and loaded_ensemble is not None and loaded_ensemble.trained_at is not None):
+        if incremental_train_pipeline(em, loaded_ensemble):
+            return
     # read and preprocess data
-    data_path = server_config.ai_module.training.data.resolved_path
-    df = read_and_prepare_data(data_path)
+    data_config = server_config.ai_module.training.data
+    df = read_and_prepare_data(data_config.resolved_path, use_cache=data_config.cache)
     df = filter_outliers_zscore(df)
-    df = normalize(df)
-    df = filter_col(df)
+    # columns are pruned on min-max scaled values, so that columns that are affine copies of each other are dropped
+    # as duplicates. The ensemble is trained on the raw values of the kept columns: it fits the scaler on the training
+    # split itself and persists it with the model
+    df = df[filter_col(normalize(df.copy())).columns]
     # train and evaluate models
     train_df, test_df = train_test_split(df, test_size=0.95, random_state=2, shuffle=True)
-    em = EnsembleManager()
     em.train_new_ensemble(df_training=train_df)
     model_result_info = em.evaluate_loaded_ensemble(df_test=test_df)
     create_static_rules_pipeline()
 
 
+def incremental_train_pipeline(em: EnsembleManager, loaded_ensemble: EnsembleModel) -> bool:
+    """
+    Continues training the loaded ensemble on the data files modified since it was trained. Returns False when a full
+    training with hyperparameter search is needed instead, i.e. when the loaded ensemble performs poorly on the new
+    data (drift) or the new data cannot be learned incrementally.
+    """
+    server_config = ConfigurationManager().get_server_config()
+    incremental_config = server_config.ai_module.incremental_training
+    data_config = server_config.ai_module.training.data
+    df = read_and_prepare_data(
+        data_config.resolved_path, use_cache=data_config.cache, modified_after=loaded_ensemble.trained_at)
+    if df.empty:
+        logging.info("[train_pipeline] no new training data since the loaded ensemble was trained")
+        return True
+    df = filter_outliers_zscore(df)
+    df = loaded_ensemble.filter_col(df)
+    classification_report, _ = loaded_ensemble.evaluate(df)
+    if classification_report['accuracy'] < incremental_config.min_accuracy:
+        logging.info(f"[train_pipeline] loaded ensemble accuracy on new data is "
+                     f"{classification_report['accuracy']:.3f}: running full training")
+        return False
+    train_df, test_df = train_test_split(df, test_size=0.95, random_state=2, shuffle=True)
+    try:
+        em.continue_loaded_ensemble(df_training=train_df)
+    except ValueError as e:
+        logging.info(f"[train_pipeline] cannot train incrementally ({e}): running full training")
+        return False
+    model_result_info = em.evaluate_loaded_ensemble(df_test=test_df)
+    create_static_rules_pipeline()
+    return True
+
+
 def create_static_rules_pipeline():
     server_config = ConfigurationManager().get_server_config()
-    data_path = server_config.ai_module.training.data.resolved_path
+    data_config = server_config.ai_module.training.data
     dataset_config = ConfigurationManager().get_dataset_config()
-    df = read_and_prepare_data(data_path)
+    df = read_and_prepare_data(data_config.resolved_path, use_cache=data_config.cache)
     em = EnsembleManager()
     em.create_rules(df, dataset_config)
-
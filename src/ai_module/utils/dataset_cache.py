@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.common.config import DatasetConfig
+
+
+class PreparedDataCache:
+    """
+    Keeps the cleaned contents of each data file as a float64 .npy array, so that files that have not changed since
+    the last run are memory-mapped instead of parsed again. Entries are keyed by the file path, its modification time
+    and size, and the dataset configuration used to clean it.
+    """
+
+    _suffix = '.npy'
+
+    def __init__(self, directory: Path, config: DatasetConfig,
+                 reader: Callable[[Path, DatasetConfig], Iterator[pd.DataFrame]]):
+        self._directory = directory
+        self._config = config
+        self._reader = reader
+        self._columns = [col.name for col in config.columns] + ['Label']
+        self._config_hash = hashlib.sha256(config.model_dump_json().encode()).hexdigest()
+
+    @staticmethod
+    def _hash(s: str) -> str:
+        return hashlib.sha256(s.encode()).hexdigest()[:16]
+
+    def _entry_prefix(self, file_path: Path) -> str:
+        return self._hash(str(file_path.resolve()))
+
+    def _entry_path(self, file_path: Path) -> Path:
+        stat = file_path.stat()
+        key = self._hash(f'{stat.st_mtime_ns}:{stat.st_size}:{self._config_hash}')
+        return self._directory / f'{self._entry_prefix(file_path)}-{key}{self._suffix}'
+
+    def read_chunks(self, file_path: Path) -> Iterator[pd.DataFrame]:
+        entry_path = self._entry_path(file_path)
+        if not entry_path.exists():
+            self._write_entry(file_path, entry_path)
+        data = np.load(entry_path, mmap_mode='r')
+        if data.size == 0:
+            return
+        for start in range(0, len(data), self._config.chunk_size):
+            chunk = pd.DataFrame(np.array(data[start:start + self._config.chunk_size]), columns=self._columns)
+            chunk['Label'] = chunk['Label'].astype(int)
+            yield chunk
+
+    def _write_entry(self, file_path: Path, entry_path: Path):
+        # entries of older versions of the same file are no longer reachable. The current entry is left for
+        # os.replace, since a concurrent writer of the same version may have just published it
+        for stale_path in self._directory.glob(f'{self._entry_prefix(file_path)}-*{self._suffix}'):
+            if stale_path != entry_path:
+                stale_path.unlink(missing_ok=True)
+        # cleaned chunks are streamed to a raw buffer first, since the number of rows is only known at the end.
+        # Periodic tasks may prepare the same file at once, so every writer gets temporary files of its own
+        raw_fd, raw_name = tempfile.mkstemp(dir=self._directory, prefix=entry_path.name, suffix='.raw')
+        tmp_name = None
+        try:
+            n_rows = 0
+            with open(raw_fd, 'wb') as raw_file:
+                for chunk in self._reader(file_path, self._config):
+                    # rows whose label has no mapping cannot be sampled, and would not fit the integer label column
+                    chunk = chunk.dropna(subset=['Label'])
+                    raw_file.write(np.ascontiguousarray(chunk[self._columns].to_numpy(dtype=np.float64)).tobytes())
+                    n_rows += len(chunk)
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float64)), 'fortran_order': False,
+                      'shape': (n_rows, len(self._columns))}
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=self._directory, prefix=entry_path.name, suffix='.tmp')
+            with open(tmp_fd, 'wb') as tmp_file, open(raw_name, 'rb') as raw_file:
+                np.lib.format.write_array_header_1_0(tmp_file, header)
+                shutil.copyfileobj(raw_file, tmp_file)
+            # the entry appears complete or not at all, whichever writer publishes last
+            os.replace(tmp_name, entry_path)
+        finally:
+            for name in (raw_name, tmp_name):
+                if name is not None:
+                    Path(name).unlink(missing_ok=True)
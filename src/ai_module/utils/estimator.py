@@ -1,11 +1,13 @@
+import numpy as np
 from lightgbm import LGBMClassifier
 from pandas import DataFrame
-from sklearn.base import BaseEstimator
+from sklearn.base import BaseEstimator, clone
 from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier, VotingClassifier
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import GridSearchCV
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.neural_network import MLPClassifier
+from sklearn.utils import Bunch
 
 from src.ai_module.utils.new_dataset import calculate_weights
 from src.common.config import AIModelsTrainingConfig
@@ -61,3 +63,43 @@ def create_ensamble(models_config: AIModelsTrainingConfig, df: DataFrame):
                 df=df
         )))
     return VotingClassifier(estimators=estimators_tuple_list, voting='soft')
+
+
+def continue_estimator(previous: BaseEstimator, x_train: DataFrame, y_train, class_weight: dict) -> BaseEstimator:
+    # keeps the hyperparameters selected when the previous estimator was searched for
+    estimator = clone(previous)
+    if estimator.get_params().get('class_weight') is not None:
+        estimator.set_params(class_weight=class_weight)
+    if isinstance(previous, LGBMClassifier):
+        # boosting goes on from the previous trees instead of starting over
+        return estimator.fit(x_train, y_train, init_model=previous.booster_)
+    # the other estimators cannot continue from a fitted state, so they are refit on the whole training set, which
+    # holds a replay sample of the data they were trained on before
+    return estimator.fit(x_train, y_train)
+
+
+def continue_ensamble(previous: VotingClassifier, df: DataFrame) -> VotingClassifier:
+    """
+    Trains the estimators of a fitted ensemble further on df, which must hold every class the ensemble was trained on,
+    e.g. the new data together with a replay sample of the previous training data. Labels keep the encoding of the
+    previous ensemble.
+    """
+    x_train = df.drop('Label', axis=1)
+    y_train = df['Label']
+    ensemble = clone(previous)
+    unseen = np.setdiff1d(np.unique(y_train), previous.classes_)
+    if len(unseen):
+        raise ValueError(f"cannot continue training an ensemble on classes it was not trained on: {unseen.tolist()}")
+    missing = np.setdiff1d(previous.classes_, np.unique(y_train))
+    if len(missing):
+        raise ValueError(f"cannot continue training an ensemble without data of classes {missing.tolist()}")
+    ensemble.le_ = previous.le_
+    ensemble.classes_ = previous.classes_
+    # VotingClassifier.fit always refits clones of its estimators from scratch, so its fitting is replicated here
+    y_encoded = ensemble.le_.transform(y_train)
+    weights = calculate_weights(df)
+    ensemble.estimators_ = [
+        continue_estimator(estimator, x_train, y_encoded, weights) for estimator in previous.estimators_]
+    ensemble.named_estimators_ = Bunch(**{
+        name: estimator for (name, _), estimator in zip(ensemble.estimators, ensemble.estimators_)})
+    return ensemble
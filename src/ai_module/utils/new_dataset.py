@@ -1,71 +1,177 @@
+import hashlib
+import logging
+from datetime import datetime
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import os
 import warnings
 from collections import Counter
 
+from pyarrow import csv
 from scipy import stats
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.utils import class_weight
-from sqlalchemy.testing.plugin.plugin_base import logging
 
-from src.common.config import ConfigurationManager, DatasetConfig, ColumnType
+from src.ai_module.utils.dataset_cache import PreparedDataCache
+from src.common.config import ConfigurationManager, DatasetConfig
+from src.common.utils import get_cache_dir
 
 
-def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-    config = ConfigurationManager().get_dataset_config()
-    df = fix_data_type(df, config)
+def clean_data(df: pd.DataFrame, config: DatasetConfig) -> pd.DataFrame:
+    # values are already typed by read_csv_chunks, with infinities and repeated headers parsed as nulls
     df = drop_null_collumns(df)
     df = generate_multi_label(df, config)
     df = drop_unnecessary_column(df)
-    df = stratified_sample(df, config.sample_size, config.num_classes)
     return df
 
 
-def read_and_prepare_data(data_path: Path) -> pd.DataFrame:
+INFINITY_TOKENS = ["Infinity", "infinity", "-Infinity", "-infinity", "inf", "-inf", "Inf", "-Inf"]
+
+
+def _read_typed_csv_chunks(file_path: Path, config: DatasetConfig, column_type: pa.DataType) \
+        -> Iterator[pd.DataFrame]:
+    column_types = {col.name: column_type for col in config.columns}
+    columns = [*column_types, 'Label']
+    convert_options = csv.ConvertOptions(
+        column_types=column_types,
+        include_columns=columns,
+        # CIC-IDS files repeat their header line in the middle of the data: its values are parsed as nulls too
+        null_values=["", "NaN", "nan", *INFINITY_TOKENS, *columns],
+        strings_can_be_null=True,
+    )
+    batches, n_rows = [], 0
+    with csv.open_csv(file_path, convert_options=convert_options) as reader:
+        for batch in reader:
+            batches.append(batch)
+            n_rows += batch.num_rows
+            if n_rows >= config.chunk_size:
+                yield pa.Table.from_batches(batches).to_pandas()
+                batches, n_rows = [], 0
+    if n_rows > 0:
+        yield pa.Table.from_batches(batches).to_pandas()
+
+
+def read_csv_chunks(file_path: Path, config: DatasetConfig) -> Iterator[pd.DataFrame]:
+    # int columns are parsed as float, since they may hold nulls until drop_null_collumns runs
+    n_read = 0
+    try:
+        for chunk in _read_typed_csv_chunks(file_path, config, pa.float64()):
+            n_read += len(chunk)
+            yield chunk
+        return
+    except pa.ArrowInvalid as e:
+        logging.warning(f"[read_csv_chunks] {file_path} holds values that are not numbers, read as nulls: {e}")
+    # the rest of the file is read as text and coerced, so a bad cell costs its row rather than the whole file
+    feature_columns = [col.name for col in config.columns]
+    for chunk in _read_typed_csv_chunks(file_path, config, pa.string()):
+        if n_read >= len(chunk):
+            n_read -= len(chunk)
+            continue
+        if n_read > 0:
+            # rows already read before the bad value
+            chunk, n_read = chunk.iloc[n_read:].copy(), 0
+        chunk[feature_columns] = chunk[feature_columns].apply(pd.to_numeric, errors='coerce').astype(np.float64)
+        yield chunk
+
+
+def read_prepared_chunks(file_path: Path, config: DatasetConfig) -> Iterator[pd.DataFrame]:
+    for chunk in read_csv_chunks(file_path, config):
+        yield clean_data(chunk, config)
+
+
+def read_and_prepare_data(
+        data_path: Path, use_cache: bool = False, modified_after: datetime | None = None) -> pd.DataFrame:
     warnings.filterwarnings("ignore")
-    final_data: pd.DataFrame = pd.DataFrame()
+    config = ConfigurationManager().get_dataset_config()
+    cache = PreparedDataCache(get_cache_dir(), config, reader=read_prepared_chunks) if use_cache else None
     if data_path.is_dir():
-        for file_path in data_path.iterdir():
-            #logging.info(f"Reading file at {file_path}")
-            if not file_path.is_file():
-                continue
-            data = pd.read_csv(file_path, low_memory=False)
-            data = prepare_data(data)
-            if len(final_data) == 0:
-                final_data = data
-            else:
-                final_data = pd.concat([final_data, data], ignore_index=True)
+        file_paths = [file_path for file_path in sorted(data_path.iterdir()) if file_path.is_file()]
     else:
-        data = pd.read_csv(data_path, low_memory=False)
-        final_data = prepare_data(data)
-    return final_data
+        file_paths = [data_path]
+    if modified_after is not None:
+        file_paths = [path for path in file_paths if path.stat().st_mtime > modified_after.timestamp()]
+    # a single sampler spans every chunk of every file, so memory is bounded by the sample, not by the dataset
+    sampler = StratifiedReservoirSampler(config.sample_size, config.num_classes)
+    for file_path in file_paths:
+        #logging.info(f"Reading file at {file_path}")
+        chunks = cache.read_chunks(file_path) if cache else read_prepared_chunks(file_path, config)
+        for chunk in chunks:
+            sampler.update(chunk)
+    return sampler.sample()
+
+
+class StratifiedReservoirSampler:
+
+    def __init__(self, k: int, n_classes: int, seed: int | None = None):
+        self._k = k
+        self._n_classes = n_classes
+        self._rng = np.random.default_rng(seed)
+        self._reservoirs: dict[int, pd.DataFrame] = {}
+        self._seen: dict[int, int] = {}
+
+    def update(self, df: pd.DataFrame):
+        for label, group in df.groupby("Label", sort=False):
+            self._update_class(int(label), group)
+
+    def _update_class(self, label: int, group: pd.DataFrame):
+        reservoir = self._reservoirs.get(label)
+        seen = self._seen.get(label, 0)
+        self._seen[label] = seen + len(group)
+        # rows arriving while the reservoir is not full are always kept
+        n_fill = max(0, min(self._k - seen, len(group)))
+        if n_fill > 0:
+            fill = group.iloc[:n_fill]
+            reservoir = fill if reservoir is None else pd.concat([reservoir, fill])
+            group = group.iloc[n_fill:]
+        if len(group) > 0:
+            # algorithm R: the t-th row of a class takes a random slot with probability k/t. Decisions do not depend
+            # on the reservoir contents, so they are drawn at once and the last row drawn for each slot wins
+            positions = np.arange(seen + n_fill, seen + n_fill + len(group))
+            slots = self._rng.integers(0, positions + 1)
+            accepted = np.flatnonzero(slots < self._k)[::-1]
+            slots, last = np.unique(slots[accepted], return_index=True)
+            keep = np.ones(len(reservoir), dtype=bool)
+            keep[slots] = False
+            reservoir = pd.concat([reservoir[keep], group.iloc[accepted[last]]])
+        self._reservoirs[label] = reservoir
+
+    def rows(self) -> pd.DataFrame:
+        # every row kept so far, unlike sample() which also thins out the benign class
+        if not self._reservoirs:
+            return pd.DataFrame()
+        return pd.concat(self._reservoirs.values())
+
+    def sample(self) -> pd.DataFrame:
+        samples = []
+        for i in range(self._n_classes):
+            reservoir = self._reservoirs.get(i)
+            if reservoir is None:
+                continue
+            if i == 0:
+                reservoir = reservoir.sample(n=int(len(reservoir)/5), random_state=self._rng)
+            samples.append(reservoir)
+        if not samples:
+            return pd.DataFrame()
+        return pd.concat(samples)
 
 
 def stratified_sample(df: pd.DataFrame, k: int, n_classes: int) -> pd.DataFrame:
-    df_sampled = pd.DataFrame()
-    for i in range(n_classes):
-        df_aux = df[df["Label"] == i]
-        sample_size = min(k, len(df_aux))
-        if i == 0:
-            sample_size = int(sample_size/5)
-        df_aux = df_aux.sample(n = sample_size)
-        df_sampled = pd.concat([df_sampled, df_aux])
-    return df_sampled
+    sampler = StratifiedReservoirSampler(k, n_classes)
+    sampler.update(df)
+    return sampler.sample()
 
 
 def drop_null_collumns(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.replace(["Infinity", "infinity"], np.inf)
-    df = df.replace([np.inf, -np.inf], np.nan)
-    df.dropna(inplace=True)
-    return df
+    is_finite = np.isfinite(df.select_dtypes(include='number').to_numpy()).all(axis=1)
+    return df[is_finite].dropna()
 
 
 def drop_unnecessary_column(df: pd.DataFrame) -> pd.DataFrame:
-    df.drop(columns="Timestamp", inplace=True)
+    df.drop(columns="Timestamp", inplace=True, errors='ignore')
     return df
 
 
@@ -80,18 +186,6 @@ def generate_multi_label(df: pd.DataFrame, config: DatasetConfig) -> pd.DataFram
     return df
 
 
-def fix_data_type(df: pd.DataFrame, config : DatasetConfig) -> pd.DataFrame:
-    columns = config.columns
-    for col in columns:
-        col_name = col.name
-        col_type = col.type
-        if col_type == ColumnType.FLOAT:
-            df[col_name] = pd.to_numeric(df[col_name], errors='coerce')
-        elif col_type == ColumnType.INT:
-            df[col_name] = pd.to_numeric(df[col_name], errors='coerce', downcast='integer')
-    return df
-
-
 def remove_columns(df: pd.DataFrame, col_names: Iterable[str]):
     not_excluded_columns = ConfigurationManager().get_dataset_config().columns_not_to_remove
     columns_to_drop = [col for col in col_names if col not in not_excluded_columns]
@@ -106,29 +200,29 @@ def drop_zero_variance_columns(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def drop_duplicates_columns(df: pd.DataFrame) -> pd.DataFrame:
+    # columns are grouped by a fingerprint of their values, so only columns sharing a fingerprint are compared
+    columns_by_fingerprint: dict[bytes, list[str]] = {}
+    for col in df.columns:
+        fingerprint = hashlib.sha1(pd.util.hash_pandas_object(df[col], index=False).to_numpy().tobytes()).digest()
+        columns_by_fingerprint.setdefault(fingerprint, []).append(col)
     duplicates = set()
-    for i in range(0, len(df.columns)):
-        col1 = df.columns[i]
-        for j in range(i+1, len(df.columns)):
-            col2 = df.columns[j]
-            if df[col1].equals(df[col2]):
-                duplicates.add(col2)
+    for columns in columns_by_fingerprint.values():
+        for i, col1 in enumerate(columns):
+            if col1 in duplicates:
+                continue
+            for col2 in columns[i+1:]:
+                if col2 not in duplicates and df[col1].equals(df[col2]):
+                    duplicates.add(col2)
     #logging.info(f"Duplicate columns: {duplicates}")
     return remove_columns(df, duplicates)
 
 
 def drop_correlated_columns(df: pd.DataFrame) -> pd.DataFrame:
     corr = df.corr(numeric_only=True)
-    correlated_col = set()
-    is_correlated = [True] * len(corr.columns)
     threshold = 0.90
-    for i in range (len(corr.columns)):
-        if(is_correlated[i]):
-            for j in range(i):
-                if (corr.iloc[i, j] >= threshold) and (is_correlated[j]):
-                    colname = corr.columns[j]
-                    is_correlated[j]=False
-                    correlated_col.add(colname)
+    # a column is dropped when any column after it is correlated with it
+    is_correlated = np.triu(corr.to_numpy() >= threshold, k=1).any(axis=1)
+    correlated_col = set(corr.columns[is_correlated])
     return remove_columns(df, correlated_col)
 
 
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import get_args
+
+import numpy as np
+
+from src.ai_module.utils.rule_index import normalize_protocol
+from src.models.fingerprint import RANGE_FIELDS
+from src.models.firewall_rule import FirewallRule, FirewallRuleBaseModel
+
+# integer ranges are inclusive sets of whole numbers, float ranges are continuous intervals
+INTEGER_DIMENSIONS = np.array([int in get_args(FirewallRuleBaseModel.model_fields[min_field].annotation)
+                               for min_field, _ in RANGE_FIELDS])
+
+
+def _spans(boxes: np.ndarray, integer: np.ndarray) -> np.ndarray:
+    # dimensions in which a box has an extent: a float range with equal bounds is a single point
+    return integer | (boxes[..., 1] > boxes[..., 0])
+
+
+def _volume(boxes: np.ndarray, integer: np.ndarray, spans: np.ndarray) -> np.ndarray:
+    """
+    Space covered by boxes, measured over the dimensions flagged in spans. Integer dimensions count the whole numbers
+    in their inclusive bounds, float dimensions their true width, so a box that is a single point in a spanned float
+    dimension covers nothing.
+    """
+    widths = np.clip(boxes[..., 1] - boxes[..., 0] + integer, 0, None)
+    return np.prod(np.where(spans, widths, 1), axis=-1)
+
+
+def _compact_boxes(boxes: np.ndarray, integer: np.ndarray, max_widening: float) \
+        -> tuple[np.ndarray, list[list[int]]]:
+    """
+    Merges overlapping or adjacent boxes of shape (n, dimensions, 2) with a sweep line over the first dimension.
+    Integer dimensions are adjacent when they are one apart, float dimensions only when they touch. Two boxes are
+    merged into their bounding box when it covers at most (1 + max_widening) times the space covered by the original
+    boxes inside them. That space is tracked as a lower bound through every merge, so repeated merges cannot widen a
+    box beyond max_widening of its original boxes. Returns the merged boxes and, for each one, the positions of the
+    original boxes it covers.
+    """
+    step = integer.astype(float)
+    members = [[i] for i in range(len(boxes))]
+    covered = _volume(boxes, integer, _spans(boxes, integer))
+    while True:
+        order = np.argsort(boxes[:, 0, 0], kind='stable')
+        boxes, members, covered = boxes[order], [members[i] for i in order], covered[order]
+        merged = np.empty_like(boxes)
+        merged_covered = np.empty_like(covered)
+        merged_members: list[list[int]] = []
+        active = np.empty(0, dtype=int)
+        for box, box_members, box_covered in zip(boxes, members, covered):
+            # boxes arrive by lower bound, so the ones that end before this one starts cannot touch any later box
+            active = active[merged[active, 0, 1] + step[0] >= box[0, 0]]
+            candidates = merged[active]
+            touching = ((candidates[:, :, 0] <= box[:, 1] + step) &
+                        (candidates[:, :, 1] + step >= box[:, 0])).all(axis=1)
+            target = None
+            if touching.any():
+                candidates, positions = candidates[touching], active[touching]
+                lower = np.minimum(candidates[:, :, 0], box[:, 0])
+                upper = np.maximum(candidates[:, :, 1], box[:, 1])
+                spans = integer | (upper > lower)
+                # a box that is a single point in a dimension the merge spans covers nothing of the merged space
+                candidates_covered = np.where((spans & ~_spans(candidates, integer)).any(axis=1),
+                                              0, merged_covered[positions])
+                box_share = np.where((spans & ~_spans(box, integer)).any(axis=1), 0, box_covered)
+                overlap = np.stack([np.maximum(candidates[:, :, 0], box[:, 0]),
+                                    np.minimum(candidates[:, :, 1], box[:, 1])], axis=-1)
+                # the original boxes overlap at most as much as the boxes holding them
+                union = np.maximum(np.maximum(candidates_covered, box_share),
+                                   candidates_covered + box_share - _volume(overlap, integer, spans))
+                accepted = _volume(np.stack([lower, upper], axis=-1), integer, spans) <= (1 + max_widening) * union
+                if accepted.any():
+                    first = np.argmax(accepted)
+                    target = positions[first]
+                    merged[target, :, 0], merged[target, :, 1] = lower[first], upper[first]
+                    merged_covered[target] = union[first]
+                    merged_members[target] += box_members
+            if target is None:
+                merged[len(merged_members)] = box
+                merged_covered[len(merged_members)] = box_covered
+                active = np.append(active, len(merged_members))
+                merged_members.append(list(box_members))
+        merged, covered = merged[:len(merged_members)], merged_covered[:len(merged_members)]
+        # a merged box may now touch boxes it was compared against before growing
+        if len(merged) == len(boxes):
+            return merged, merged_members
+        boxes, members = merged, merged_members
+
+
+def compact_rules(rules: list[FirewallRule], max_widening: float) -> list[tuple[FirewallRule, list[int]]]:
+    """
+    Merges rules of the same destination port, protocol and action whose ranges overlap or are adjacent, so that
+    fewer, wider rules cover the same traffic. A merged rule covers at most max_widening more space than the rules it
+    replaces. Returns every resulting rule with the positions of the rules it replaces. Rules with an unset range are
+    kept as they are.
+    """
+    groups: dict[tuple, list[int]] = {}
+    compacted: list[tuple[FirewallRule, list[int]]] = []
+    for i, rule in enumerate(rules):
+        bounds = [getattr(rule, field) for fields in RANGE_FIELDS for field in fields]
+        if any(bound is None for bound in bounds):
+            compacted.append((rule, [i]))
+            continue
+        groups.setdefault((rule.dst_port, normalize_protocol(rule.protocol), rule.action), []).append(i)
+    for positions in groups.values():
+        boxes = np.array([[(getattr(rules[i], min_field), getattr(rules[i], max_field))
+                           for min_field, max_field in RANGE_FIELDS] for i in positions], dtype=float)
+        merged, merged_members = _compact_boxes(boxes, INTEGER_DIMENSIONS, max_widening)
+        for box, box_members in zip(merged, merged_members):
+            members = [positions[member] for member in box_members]
+            if len(members) == 1:
+                compacted.append((rules[members[0]], members))
+                continue
+            fields = {}
+            for (min_field, max_field), (lower, upper), integer in zip(RANGE_FIELDS, box, INTEGER_DIMENSIONS):
+                cast = int if integer else float
+                fields[min_field], fields[max_field] = cast(lower), cast(upper)
+            first = rules[members[0]]
+            compacted.append((FirewallRule(dst_port=first.dst_port, protocol=first.protocol, action=first.action,
+                                           **fields), sorted(members)))
+    return compacted
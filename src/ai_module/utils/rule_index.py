@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+from sqlalchemy import tuple_
+from sqlmodel import Session
+
+from src.models.critical_rule import CriticalRule
+from src.models.fingerprint import RANGE_FIELDS
+from src.models.firewall_rule import FirewallRuleBaseModel, FirewallRule
+
+
+def normalize_protocol(protocol: str | None) -> str | None:
+    return protocol.lower() if protocol is not None else None
+
+
+def get_range_bounds(rule: FirewallRuleBaseModel | CriticalRule) -> list[float]:
+    # unset ranges are unbounded, so they overlap with everything
+    bounds = []
+    for min_field, max_field in RANGE_FIELDS:
+        lower, upper = getattr(rule, min_field), getattr(rule, max_field)
+        if lower is None or upper is None:
+            lower, upper = -np.inf, np.inf
+        bounds += [lower, upper]
+    return bounds
+
+
+class CriticalRuleIndex:
+
+    def __init__(self, critical_rules: Iterable[CriticalRule]):
+        grouped: dict[tuple[str | None, int | None], list[list[float]]] = {}
+        for critical_rule in critical_rules:
+            bounds = get_range_bounds(critical_rule)
+            protocol = normalize_protocol(critical_rule.protocol)
+            if protocol is None and critical_rule.dst_port is None and np.isinf(bounds).all():
+                # a critical rule that restricts nothing is not meant to match every candidate
+                continue
+            grouped.setdefault((protocol, critical_rule.dst_port), []).append(bounds)
+        self._groups: dict[tuple[str | None, int | None], np.ndarray] = {}
+        for key, rows in grouped.items():
+            bounds = np.array(rows, dtype=float)
+            self._groups[key] = bounds[np.argsort(bounds[:, 0], kind='stable')]
+
+    @classmethod
+    def from_session(cls, session: Session) -> CriticalRuleIndex:
+        return cls(session.query(CriticalRule).all())
+
+    def __len__(self) -> int:
+        return sum(len(bounds) for bounds in self._groups.values())
+
+    def collides(self, rule: FirewallRuleBaseModel) -> bool:
+        protocol = normalize_protocol(rule.protocol)
+        candidate = np.array(get_range_bounds(rule), dtype=float)
+        lower, upper = candidate[0::2], candidate[1::2]
+        # critical rules without protocol or port act as wildcards for that dimension
+        keys = {(protocol, rule.dst_port), (protocol, None), (None, rule.dst_port), (None, None)}
+        for key in keys:
+            bounds = self._groups.get(key)
+            if bounds is None:
+                continue
+            # rows are sorted by their first lower bound: only a prefix of them can overlap the candidate
+            end = np.searchsorted(bounds[:, 0], upper[0], side='right')
+            if end == 0:
+                continue
+            bounds = bounds[:end]
+            overlaps = (bounds[:, 0::2] <= upper) & (bounds[:, 1::2] >= lower)
+            if overlaps.all(axis=1).any():
+                return True
+        return False
+
+
+class FirewallRuleIndex:
+    _tolerance = 0.2
+    _max_block_size = 2 ** 22
+    _max_keys_per_query = 500
+
+    def __init__(self, rows: Iterable[tuple]):
+        # rows are (dst_port, protocol, min_fl_byt_s, max_fl_byt_s, ..., min_tot_bw_pk, max_tot_bw_pk)
+        grouped: dict[tuple[int | None, str | None], list[tuple]] = {}
+        for dst_port, protocol, *bounds in rows:
+            grouped.setdefault((dst_port, normalize_protocol(protocol)), []).append(bounds)
+        # unset bounds become NaN, which never satisfies the tolerance checks
+        self._groups: dict[tuple[int | None, str | None], np.ndarray] = {
+            key: np.array(bounds, dtype=float) for key, bounds in grouped.items()}
+
+    @classmethod
+    def from_session(cls, session: Session, keys: Iterable[tuple[int | None, str | None]] | None = None) \
+            -> FirewallRuleIndex:
+        """
+        Loads the rules of the given (dst_port, protocol) pairs through the (protocol, dst_port) index, or the whole
+        table when no keys are given. Protocols are matched as stored.
+        """
+        columns = [FirewallRule.dst_port, FirewallRule.protocol] + [
+            getattr(FirewallRule, field) for fields in RANGE_FIELDS for field in fields]
+        if keys is None:
+            return cls(session.query(*columns).all())
+        keys = sorted({(protocol, dst_port) for dst_port, protocol in keys}, key=str)
+        rows = []
+        for start in range(0, len(keys), cls._max_keys_per_query):
+            rows += session.query(*columns).filter(
+                tuple_(FirewallRule.protocol, FirewallRule.dst_port).in_(keys[start:start + cls._max_keys_per_query]))
+        return cls(rows)
+
+    def __len__(self) -> int:
+        return sum(len(bounds) for bounds in self._groups.values())
+
+    def find_duplicates(self, dst_ports: Iterable[int], protocols: Iterable[str], values: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean mask telling which candidates are already covered by an existing rule of the same
+        destination port and protocol. `values` holds one row per candidate with its flow bytes/s, flow packets/s,
+        total forward packets and total backward packets.
+        """
+        values = np.asarray(values, dtype=float).reshape(-1, len(RANGE_FIELDS))
+        candidate_groups: dict[tuple[int | None, str | None], list[int]] = {}
+        for i, (dst_port, protocol) in enumerate(zip(dst_ports, protocols)):
+            candidate_groups.setdefault((dst_port, normalize_protocol(protocol)), []).append(i)
+        is_duplicate = np.zeros(len(values), dtype=bool)
+        for key, positions in candidate_groups.items():
+            bounds = self._groups.get(key)
+            if bounds is None:
+                continue
+            lower, upper = bounds[:, 0::2], bounds[:, 1::2]
+            margin = self._tolerance * (upper - lower)
+            positions = np.array(positions)
+            # limit the size of the (candidates x rules x dimensions) comparison tensor
+            block_size = max(1, self._max_block_size // (len(bounds) * len(RANGE_FIELDS)))
+            for start in range(0, len(positions), block_size):
+                block = positions[start:start + block_size]
+                x = values[block][:, np.newaxis, :]
+                within = (np.abs(x - upper) - np.abs(x - lower)) < margin
+                is_duplicate[block] = within.all(axis=2).any(axis=1)
+        return is_duplicate
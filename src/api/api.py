@@ -38,4 +38,5 @@ api.add_middleware(
 @api.exception_handler(IHTTPExceptionProvider)
 async def handle_db_exceptions(_: Request, exc: IHTTPExceptionProvider):
     http_exc = exc.get_http_exception()
-    return JSONResponse(status_code=http_exc.status_code, content={'detail': http_exc.detail})
+    return JSONResponse(status_code=http_exc.status_code, content={'detail': http_exc.detail},
+                        headers=http_exc.headers)
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Depends
 
+from src.api.filters import RuleFilterParams
 from src.common.exceptions.db import NotFoundDbException, NoUpdatesProvidedDbException
 from src.models.critical_rule import CriticalRuleCreateModel, CriticalRuleUpdateModel, \
     CriticalRuleOutModel, CriticalRule, GetAllCriticalRules
 from src.services.auth import UserLoggedIn
-from src.services.database import InjectedSession
+from src.services.database import InjectedSession, InjectedAsyncSession, get_page
 
 router = APIRouter(prefix='/critical-rules', tags=['Critical Rules'])
 
@@ -12,20 +13,24 @@ ENTITY = 'critical rule'
 
 
 @router.get('/', response_model=GetAllCriticalRules, dependencies=[UserLoggedIn])
-def get_all(
-        session: InjectedSession,
+async def get_all(
+        session: InjectedAsyncSession,
         page: int = Query(default=0, ge=0),
         page_size: int | None = Query(default=100, ge=0, alias='pageSize'),
+        after: int | None = Query(default=None, description='id of the last row of the previous page'),
+        rule_filter: RuleFilterParams = Depends(),
         ):
-    total_rows = session.query(CriticalRule).count()
-    crs: list[CriticalRuleOutModel] = (session.query(CriticalRule).order_by(CriticalRule.id)
-                                       .offset(page * page_size).limit(page_size).all())
-    return GetAllCriticalRules(total=total_rows, data=crs)
+    columns = rule_filter.get_columns(CriticalRuleOutModel)
+    crs, total_rows, next_cursor = await get_page(
+        session, CriticalRule, page, page_size, after, filters=rule_filter.get_filters(CriticalRule), columns=columns)
+    if columns is not None:
+        crs = rule_filter.project(crs)
+    return GetAllCriticalRules(total=total_rows, data=crs, next_cursor=next_cursor)
 
 
 @router.get('/{id}', response_model=CriticalRuleOutModel, dependencies=[UserLoggedIn])
-def get_one(id: int, session: InjectedSession):
-    cr = session.query.get(id)
+async def get_one(id: int, session: InjectedAsyncSession):
+    cr = await session.get(CriticalRule, id)
     if cr is None:
         raise NotFoundDbException(ENTITY)
     return cr
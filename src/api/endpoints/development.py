@@ -5,7 +5,7 @@ from src.models.critical_rule import CriticalRule
 from src.models.firewall_rule import FirewallRule
 from src.models.user import User
 from src.services.auth import UserLoggedIn
-from src.services.database import InjectedSession
+from src.services.database import InjectedSession, DBSessionManager, PoolMetrics
 
 router = APIRouter(prefix='/dev', tags=['Development'])
 
@@ -30,3 +30,13 @@ def mock_data(config: MockConfig, session: InjectedSession):
         success = success and FirewallRule.bulk_create(session, firewall_rules, commit=False)
     session.commit()
     return success
+
+
+@router.get('/db-pool', response_model=PoolMetrics, dependencies=[UserLoggedIn])
+def get_db_pool_metrics():
+    return DBSessionManager().get_pool_metrics()
+
+
+@router.get('/db-pool/async', response_model=PoolMetrics, dependencies=[UserLoggedIn])
+def get_async_db_pool_metrics():
+    return DBSessionManager().get_async_pool_metrics()
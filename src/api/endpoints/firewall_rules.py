@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Depends
 
+from src.api.filters import RuleFilterParams
 from src.common.exceptions.db import NotFoundDbException
 from src.models.firewall_rule import FirewallRule, FirewallRuleOutModel, GetAllFirewallRules
 from src.services.auth import UserLoggedIn
-from src.services.database import InjectedSession
+from src.services.database import InjectedAsyncSession, get_page
 
 router = APIRouter(prefix='/firewall-rules', tags=['Firewall Rules'])
 
@@ -11,20 +12,24 @@ ENTITY = 'firewall rule'
 
 
 @router.get('/', response_model=GetAllFirewallRules, dependencies=[UserLoggedIn])
-def get_all(
-        session: InjectedSession,
+async def get_all(
+        session: InjectedAsyncSession,
         page: int = Query(default=0, ge=0),
         page_size: int | None = Query(default=100, ge=0, alias='pageSize'),
+        after: int | None = Query(default=None, description='id of the last row of the previous page'),
+        rule_filter: RuleFilterParams = Depends(),
         ):
-    total_rows = session.query(FirewallRule).count()
-    fwrs: list[FirewallRuleOutModel] = (session.query(FirewallRule).order_by(FirewallRule.id)
-                                       .offset(page * page_size).limit(page_size).all())
-    return GetAllFirewallRules(data=fwrs, total=total_rows)
+    columns = rule_filter.get_columns(FirewallRuleOutModel)
+    fwrs, total_rows, next_cursor = await get_page(
+        session, FirewallRule, page, page_size, after, filters=rule_filter.get_filters(FirewallRule), columns=columns)
+    if columns is not None:
+        fwrs = rule_filter.project(fwrs)
+    return GetAllFirewallRules(data=fwrs, total=total_rows, next_cursor=next_cursor)
 
 
 @router.get('/{id}', response_model=FirewallRuleOutModel, dependencies=[UserLoggedIn])
-def get_by_id(id: int, session: InjectedSession):
-    fwr = session.query.get(id)
+async def get_by_id(id: int, session: InjectedAsyncSession):
+    fwr = await session.get(FirewallRule, id)
     if fwr is None:
         raise NotFoundDbException(ENTITY)
     return fwr
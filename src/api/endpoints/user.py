@@ -9,7 +9,7 @@ from src.common.exceptions.db import NotFoundDbException, NoUpdatesProvidedDbExc
 from src.common.exceptions.model import DeletionOfActiveUserException
 from src.models.user import UserOutModel, UserCreateModel, UserUpdateModel, User, GetAllUsers
 from src.services.auth import TokenAuthManager, InjectedCurrentUser, UserLoggedIn
-from src.services.database import InjectedSession
+from src.services.database import InjectedSession, InjectedAsyncSession, get_page
 
 router = APIRouter(prefix='/users', tags=['Users'])
 
@@ -19,20 +19,21 @@ ENTITY = 'user'
 @router.post(path='/login')
 async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
                 session: InjectedSession, config: InjectedTokenConfig):
-    user = User.authenticate(session, identifier=form_data.username, password=form_data.password)
+    user = await User.authenticate_async(session, identifier=form_data.username, password=form_data.password)
+    TokenAuthManager().invalidate_user(user.id)
     access_token = TokenAuthManager().generate_token(user, session, config)
     return {'access_token': access_token, 'token_type': 'bearer'}
 
 
 @router.get('/', response_model=GetAllUsers, dependencies=[UserLoggedIn])
-def get_all(
-        session: InjectedSession,
+async def get_all(
+        session: InjectedAsyncSession,
         page: int = Query(default=0, ge=0),
         page_size: int | None = Query(default=100, ge=0, alias='pageSize'),
+        after: int | None = Query(default=None, description='id of the last row of the previous page'),
         ):
-    total_rows = session.query(User).count()
-    users = session.query(User).order_by(User.id).offset(page * page_size).limit(page_size).all()
-    return GetAllUsers(data=users, total=total_rows)
+    users, total_rows, next_cursor = await get_page(session, User, page, page_size, after)
+    return GetAllUsers(data=users, total=total_rows, next_cursor=next_cursor)
 
 
 @router.get(path='/me', response_model=UserOutModel)
@@ -43,8 +44,8 @@ def get_user_me(current_user: InjectedCurrentUser):
 
 
 @router.get('/{id}', response_model=UserOutModel, dependencies=[UserLoggedIn])
-def get_one(id: int, session: InjectedSession):
-    user = session.query.get(id)
+async def get_one(id: int, session: InjectedAsyncSession):
+    user = await session.get(User, id)
     if user is None:
         raise NotFoundDbException(ENTITY)
     return user
@@ -62,7 +63,9 @@ def update(id: int, item: UserUpdateModel, session: InjectedSession):
     user: User = session.query(User).get(id)
     if user is None:
         raise NotFoundDbException(ENTITY)
-    return user.update_from(update_model=item).update(session)
+    user = user.update_from(update_model=item).update(session)
+    TokenAuthManager().invalidate_user(id)
+    return user
 
 
 @router.put('/{id}/toggle', response_model=UserOutModel, dependencies=[UserLoggedIn])
@@ -73,7 +76,9 @@ def toggle_active(id: int, session: InjectedSession):
     if not user.active:
         user.login_attempts = 0
     user.active = not user.active
-    return user.update(session)
+    user = user.update(session)
+    TokenAuthManager().invalidate_user(id)
+    return user
 
 
 @router.delete('/{id}', response_model=bool, dependencies=[UserLoggedIn])
@@ -84,4 +89,5 @@ def delete_one(id: int, session: InjectedSession):
     if user.active:
         raise DeletionOfActiveUserException(user)
     user.delete(session)
+    TokenAuthManager().invalidate_user(id)
     return True
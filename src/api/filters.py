@@ -0,0 +1,87 @@
+from datetime import datetime
+from typing import Any
+
+from fastapi import Query
+from pydantic.alias_generators import to_camel
+from sqlalchemy import ColumnElement, or_
+
+from src.common.exceptions.db import InvalidProjectionDbException
+from src.common.utils import convert_str_camel_to_snake
+from src.models.base import BaseModel
+from src.models.enums import Action
+from src.models.fingerprint import RANGE_FIELDS
+
+
+class RuleFilterParams:
+    """
+    Query parameters shared by the rule list endpoints. Every filter is optional and they are combined with AND.
+    A range given by minX/maxX matches the rules whose own X range overlaps it, rules without an X range included.
+    """
+
+    def __init__(
+            self,
+            protocol: str | None = Query(default=None),
+            dst_port: int | None = Query(default=None, alias='dstPort'),
+            action: Action | None = Query(default=None),
+            created_after: datetime | None = Query(default=None, alias='createdAfter'),
+            created_before: datetime | None = Query(default=None, alias='createdBefore'),
+            min_fl_byt_s: float | None = Query(default=None, alias='minFlBytS'),
+            max_fl_byt_s: float | None = Query(default=None, alias='maxFlBytS'),
+            min_fl_pkt_s: float | None = Query(default=None, alias='minFlPktS'),
+            max_fl_pkt_s: float | None = Query(default=None, alias='maxFlPktS'),
+            min_tot_fw_pk: int | None = Query(default=None, alias='minTotFwPk'),
+            max_tot_fw_pk: int | None = Query(default=None, alias='maxTotFwPk'),
+            min_tot_bw_pk: int | None = Query(default=None, alias='minTotBwPk'),
+            max_tot_bw_pk: int | None = Query(default=None, alias='maxTotBwPk'),
+            fields: list[str] | None = Query(
+                default=None, description='fields to return, besides id; every field is returned if omitted'),
+    ):
+        self.protocol = protocol
+        self.dst_port = dst_port
+        self.action = action
+        self.created_after = created_after
+        self.created_before = created_before
+        self.ranges = {
+            'min_fl_byt_s': min_fl_byt_s, 'max_fl_byt_s': max_fl_byt_s,
+            'min_fl_pkt_s': min_fl_pkt_s, 'max_fl_pkt_s': max_fl_pkt_s,
+            'min_tot_fw_pk': min_tot_fw_pk, 'max_tot_fw_pk': max_tot_fw_pk,
+            'min_tot_bw_pk': min_tot_bw_pk, 'max_tot_bw_pk': max_tot_bw_pk,
+        }
+        self.fields = fields
+
+    def get_filters(self, model: type) -> list[ColumnElement[bool]]:
+        filters = []
+        if self.protocol is not None:
+            # protocols are stored both as given by the dataset and in lowercase, and an IN keeps the index usable
+            filters.append(model.protocol.in_({self.protocol, self.protocol.lower(), self.protocol.upper()}))
+        if self.dst_port is not None:
+            filters.append(model.dst_port == self.dst_port)
+        if self.action is not None:
+            filters.append(model.action == self.action)
+        if self.created_after is not None:
+            filters.append(model.created_at >= self.created_after)
+        if self.created_before is not None:
+            filters.append(model.created_at <= self.created_before)
+        for min_field, max_field in RANGE_FIELDS:
+            lower, upper = self.ranges[min_field], self.ranges[max_field]
+            # unset bounds of a rule are unbounded
+            if lower is not None:
+                filters.append(or_(getattr(model, max_field).is_(None), getattr(model, max_field) >= lower))
+            if upper is not None:
+                filters.append(or_(getattr(model, min_field).is_(None), getattr(model, min_field) <= upper))
+        return filters
+
+    def get_columns(self, out_model: type[BaseModel]) -> list[str] | None:
+        if self.fields is None:
+            return None
+        # fields may be repeated or comma separated, and given as in the responses, in camelCase, or in snake_case
+        fields = [field.strip() for value in self.fields for field in value.split(',') if field.strip()]
+        columns = [convert_str_camel_to_snake(field) for field in fields]
+        invalid = [field for field, column in zip(fields, columns) if column not in out_model.model_fields]
+        if invalid:
+            raise InvalidProjectionDbException(invalid)
+        return columns
+
+    @staticmethod
+    def project(rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        return [{to_camel(column): value for column, value in row.items()} for row in rows]
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
 
 from sqlmodel import Session
 
@@ -19,3 +20,6 @@ class TokenAuthService(ABC):
     @abstractmethod
     def authenticate_token(self, token: str) -> User | None:
         pass
+
+    def get_expiration(self, token: str) -> datetime | None:
+        return None
@@ -57,6 +57,15 @@ class DbConfig(BaseModel):
     user: str
     password: str
     verbose: bool = False
+    pool_size: int = Field(ge=1, default=10)
+    max_overflow: int = Field(ge=0, default=20)
+    pool_timeout_seconds: float = Field(gt=0, default=30)
+    pool_recycle_seconds: int = Field(ge=-1, default=1800)
+    pool_pre_ping: bool = True
+    statement_timeout_ms: int | None = Field(gt=0, default=30_000)
+    async_dbms: str | None = None
+    exact_count_threshold: int = Field(ge=0, default=10_000)
+    count_cache_seconds: float = Field(ge=0, default=30)
 
 
 class PersistenceConfig(BaseModel):
@@ -124,6 +133,7 @@ class AIModuleConfig(BaseModel):
         class DataConfig(BaseModel):
             type: TrainingDataTypeOption = TrainingDataTypeOption.FILE
             path: str = '$data/log.xlsx'
+            cache: bool = True
 
             @cached_property
             @resolve_variables_in_path
@@ -134,9 +144,21 @@ class AIModuleConfig(BaseModel):
         run_on_start: bool = False
         data: DataConfig
 
+    class IncrementalTrainingConfig(BaseModel):
+        enable: bool = False
+        full_training_cron_string: str = '0 3 * * *'
+        min_accuracy: float = Field(ge=0, le=1, default=0.9)
+        replay_sample_size: int = Field(gt=0, default=5000)
+
+    class RuleCompactionConfig(BaseModel):
+        enable: bool = True
+        max_widening: float = Field(ge=0, default=0.1)
+
     training: PeriodicDataReadingConfig
     static_rule_creation: PeriodicDataReadingConfig
     persistence: PersistenceConfig
+    incremental_training: IncrementalTrainingConfig = IncrementalTrainingConfig()
+    rule_compaction: RuleCompactionConfig = RuleCompactionConfig()
 
 
 class AuthConfig(BaseModel):
@@ -151,17 +173,40 @@ class AuthConfig(BaseModel):
         max_login_tries: int | None = None
         notify_on_max_tries: bool = True
 
+    class CacheConfig(BaseModel):
+        enable: bool = True
+        max_size: int = Field(gt=0, default=1024)
+        ttl_seconds: float = Field(gt=0, default=60)
+
+    class PasswordHashingConfig(BaseModel):
+        max_workers: int | None = Field(gt=0, default=None)
+        max_pending: int = Field(gt=0, default=64)
+
     token: TokenConfig
     login: LoginConfig
+    cache: CacheConfig = CacheConfig()
+    password_hashing: PasswordHashingConfig = PasswordHashingConfig()
+
+class FirewallBackendOption(str, Enum):
+    IPTABLES = 'iptables'
+    NFTABLES = 'nftables'
+
 
 class FirewallConfig(BaseModel):
     chain: str
     table: str
+    backend: FirewallBackendOption = FirewallBackendOption.IPTABLES
+    sync_cron_string: str | None = None
+    sync_on_start: bool = False
+    host_timeout_seconds: float | None = Field(gt=0, default=300)
 
 class ExecutorConfig(BaseModel):
     ssh_host: str
     ssh_user: str
     ssh_key_path: str
+    control_persist_seconds: int = Field(ge=0, default=600)
+    max_concurrent_commands: int = Field(gt=0, default=8)
+    timeout_seconds: float | None = Field(gt=0, default=60)
 
 class ServerConfig(BaseConfig):
     __config__filename__ = 'server.json'
@@ -175,6 +220,12 @@ class ServerConfig(BaseConfig):
     authentication: AuthConfig
     firewall_info: FirewallConfig
     executor_credentials: ExecutorConfig
+    # further firewall hosts that receive the same rules as the one in executor_credentials
+    additional_executor_credentials: list[ExecutorConfig] = []
+
+    @property
+    def all_executor_credentials(self) -> list[ExecutorConfig]:
+        return [self.executor_credentials, *self.additional_executor_credentials]
 
 
 class BaseAIModelConfig(BaseModel):
@@ -256,6 +307,7 @@ class DatasetConfig(BaseConfig):
     mapping: list[MappingConfig]
     protocol: list[str]
     sample_size: int
+    chunk_size: int = 100_000
 
     @property
     def num_classes(self) -> int:
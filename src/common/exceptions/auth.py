@@ -1,6 +1,7 @@
 from fastapi import HTTPException
 from starlette.status import (
-    HTTP_403_FORBIDDEN, HTTP_501_NOT_IMPLEMENTED, HTTP_401_UNAUTHORIZED, HTTP_429_TOO_MANY_REQUESTS)
+    HTTP_403_FORBIDDEN, HTTP_501_NOT_IMPLEMENTED, HTTP_401_UNAUTHORIZED, HTTP_429_TOO_MANY_REQUESTS,
+    HTTP_503_SERVICE_UNAVAILABLE)
 
 from src.common.exceptions.httpexc_provider import IHTTPExceptionProvider
 
@@ -47,3 +48,9 @@ class LoginTriesLimitExceeded(IHTTPExceptionProvider):
     def get_http_exception(self) -> HTTPException:
         message = "Maximum number of login tries was exceeded, resulting in account block."
         return HTTPException(status_code=HTTP_429_TOO_MANY_REQUESTS, detail=message)
+
+
+class PasswordHashingOverloadedException(IHTTPExceptionProvider):
+    def get_http_exception(self) -> HTTPException:
+        message = "Too many password verifications in progress, try again later."
+        return HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=message, headers={'Retry-After': '1'})
@@ -49,6 +49,15 @@ class NoUpdatesProvidedDbException(DbException):
         return HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f'No updates provided for {self.origin}')
 
 
+class InvalidProjectionDbException(IHTTPExceptionProvider):
+
+    def __init__(self, fields: list[str]):
+        self.fields = fields
+
+    def get_http_exception(self):
+        return HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f'Unknown fields: {", ".join(self.fields)}')
+
+
 class DbManagerNotLoadedException(IHTTPExceptionProvider):
 
     def get_http_exception(self):
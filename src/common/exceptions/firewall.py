@@ -0,0 +1,13 @@
+from typing import Any
+
+
+class FirewallHostsFailedException(RuntimeError):
+
+    def __init__(self, results: dict[str, Any]):
+        # the result of every host, with the exception of those that failed or timed out
+        self.results = results
+        self.failed_hosts = [host for host, result in results.items() if isinstance(result, BaseException)]
+        super().__init__(self.get_msg())
+
+    def get_msg(self):
+        return f"Firewall operation failed on hosts: {', '.join(self.failed_hosts)}"
@@ -0,0 +1,69 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import BoundedSemaphore
+from typing import Callable, TypeVar
+
+import bcrypt
+
+from src.common.config import ConfigurationManager, AuthConfig
+from src.common.exceptions.auth import PasswordHashingOverloadedException
+from src.common.singleton import LoadableSingleton
+
+T = TypeVar('T')
+
+
+class PasswordHashingPool(LoadableSingleton):
+    """
+    Runs bcrypt on a dedicated, bounded pool of threads (bcrypt releases the GIL while hashing), so that hashing
+    neither blocks the event loop nor takes the threads other requests run on. At most maxPending operations may be
+    running or queued at once: beyond that, new ones are rejected right away instead of piling up behind a burst of
+    logins.
+    """
+
+    def __init__(self):
+        self._config: AuthConfig.PasswordHashingConfig | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._admission: BoundedSemaphore | None = None
+        super().__init__()
+
+    def _load(self):
+        self._config = ConfigurationManager().get_auth_config().password_hashing
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._config.max_workers or os.cpu_count() or 1, thread_name_prefix='password-hashing')
+        self._admission = BoundedSemaphore(self._config.max_pending)
+
+    def _loaded(self) -> bool:
+        return self._executor is not None
+
+    def _submit(self, fn: Callable[..., T], *args) -> Future:
+        with self.load_guard():
+            if not self._admission.acquire(blocking=False):
+                raise PasswordHashingOverloadedException()
+            try:
+                future = self._executor.submit(fn, *args)
+            except BaseException:
+                self._admission.release()
+                raise
+            future.add_done_callback(lambda _: self._admission.release())
+            return future
+
+    @staticmethod
+    def _hash(password: str) -> str:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+    @staticmethod
+    def _check(password: str, password_hash: str) -> bool:
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+    def hash_password(self, password: str) -> str:
+        return self._submit(self._hash, password).result()
+
+    def check_password(self, password: str, password_hash: str) -> bool:
+        return self._submit(self._check, password, password_hash).result()
+
+    async def hash_password_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(self._hash, password))
+
+    async def check_password_async(self, password: str, password_hash: str) -> bool:
+        return await asyncio.wrap_future(self._submit(self._check, password, password_hash))
@@ -37,6 +37,7 @@ def get_project_dir() -> Path:
 get_data_dir = get_subdir_factory('data')
 get_config_dir = get_subdir_factory('config')
 get_statics_dir = get_subdir_factory('statics')
+get_cache_dir = get_subdir_factory('cache')
 
 
 _path_vars = {
@@ -44,6 +45,7 @@ _path_vars = {
     '$data': get_data_dir(),
     '$config': get_config_dir(),
     '$statics': get_statics_dir(),
+    '$cache': get_cache_dir(),
 }
 
 
@@ -11,6 +11,11 @@ from src.services.notification import FWRuleNotificationServiceManager
 from src.services.task import TaskManager, PeriodicTask
 
 
+def create_admin_if_none_exists():
+    with DBSessionManager().get_session() as session:
+        User.create_admin_if_none_exists(session=session)
+
+
 def build_task_manager(config: ServerConfig) -> TaskManager:
     tm = TaskManager()
     # create periodic tasks
@@ -24,6 +29,11 @@ def build_task_manager(config: ServerConfig) -> TaskManager:
         task=lambda: create_static_rules_pipeline(),
         run_on_start=config.ai_module.static_rule_creation.run_on_start
     )
+    full_retraining_task = PeriodicTask(
+        cron_string=config.ai_module.incremental_training.full_training_cron_string,
+        task=lambda: train_pipeline(full_training=True),
+        run_on_start=False,
+    )
     send_enqueued_fw_notifications = PeriodicTask(
         cron_string=config.notification.cron_string,
         task=lambda: FWRuleNotificationServiceManager().send_notifications(),
@@ -32,13 +42,22 @@ def build_task_manager(config: ServerConfig) -> TaskManager:
     # add tasks
     tm.add_startup_task(DBSessionManager().load, name="LoadDBSessionManager")\
       .add_startup_task(DBSessionManager().create_db_and_tables, name="CreateDBAndTables")\
-      .add_asynchronous_task(User.create_admin_if_none_exists, name="CreateAdminIfNoneExists",
-                             session=DBSessionManager().get_session())\
+      .add_asynchronous_task(create_admin_if_none_exists, name="CreateAdminIfNoneExists")\
       .add_asynchronous_task(TokenAuthManager().load, name="LoadTokenAuthManager")\
       .add_asynchronous_task(EnsembleManager().load, name="LoadEnsembleManager")\
       .add_periodic_task(retraining_task, name="ModelRetrainingTask")\
       .add_periodic_task(send_enqueued_fw_notifications, name="SendEnqueuedFWNotifications")\
       .add_periodic_task(create_static_rules, name="CreateStaticRules")
+    if config.firewall_info.sync_cron_string is not None:
+        sync_firewall_rules = PeriodicTask(
+            cron_string=config.firewall_info.sync_cron_string,
+            task=lambda: EnsembleManager().sync_firewall_rules(),
+            run_on_start=config.firewall_info.sync_on_start,
+        )
+        tm.add_periodic_task(sync_firewall_rules, name="SyncFirewallRules")
+    if config.ai_module.incremental_training.enable:
+        # the regular retraining task only continues the loaded ensemble, so full searches run on their own schedule
+        tm.add_periodic_task(full_retraining_task, name="FullModelRetrainingTask")
     return tm
 
 
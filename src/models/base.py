@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Iterable
+from typing import Iterable, Any, Mapping, ClassVar
 
 from pydantic.alias_generators import to_camel
-from sqlalchemy import exc
-from sqlmodel import SQLModel, Field, Session
+from sqlalchemy import exc, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import SQLModel, Field, Session, select
 
 
 class BaseModel(SQLModel):
@@ -67,6 +68,100 @@ class BaseSQLModel(BaseModel):
             session.rollback()
             return False
 
+    _bulk_insert_batch_size: ClassVar[int] = 10_000
+    _unique_lookup_batch_size: ClassVar[int] = 1_000
+
+    @classmethod
+    def _get_rows(cls, rows: Iterable[BaseSQLModel | Mapping[str, Any]] | Any) -> list[dict[str, Any]]:
+        # rows may be model instances, mappings of column name to value, or a DataFrame with one column per field
+        if hasattr(rows, 'to_dict'):
+            rows = rows.to_dict('records')
+        columns = cls.__table__.columns.keys()
+        now = datetime.utcnow()
+        prepared = []
+        for row in rows:
+            values = row.model_dump() if isinstance(row, SQLModel) else dict(row)
+            values = {column: value for column, value in values.items() if column in columns}
+            if values.get('id') is None:
+                values.pop('id', None)
+            # timestamps are filled by the model, not by the database, so a core insert must set them
+            values.setdefault('created_at', now)
+            values.setdefault('updated_at', now)
+            prepared.append(values)
+        # every row of an executemany must bind the same parameters
+        keys = set().union(*prepared) if prepared else set()
+        return [{key: values.get(key) for key in keys} for values in prepared]
+
+    @classmethod
+    def _drop_conflicting_rows(cls, session: Session, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        # rows holding a value of a unique column that is already in the table, or in an earlier row, would violate
+        # its constraint. Values are looked up in batches, since databases limit the parameters of a statement
+        for column in [column for column in cls.__table__.columns if column.unique]:
+            values = list({row[column.name] for row in rows if row.get(column.name) is not None})
+            existing = set()
+            for start in range(0, len(values), cls._unique_lookup_batch_size):
+                existing.update(session.scalars(
+                    select(column).where(column.in_(values[start:start + cls._unique_lookup_batch_size]))))
+            kept = []
+            for row in rows:
+                value = row.get(column.name)
+                if value is not None:
+                    if value in existing:
+                        continue
+                    existing.add(value)
+                kept.append(row)
+            rows = kept
+        return rows
+
+    @classmethod
+    def bulk_insert(cls, session: Session, rows: Iterable[BaseSQLModel | Mapping[str, Any]] | Any,
+                    on_conflict_do_nothing: bool = False, commit: bool = True) -> list[int]:
+        """
+        Inserts rows through executemany of a single INSERT statement, without building ORM objects or tracking them
+        in the session. With on_conflict_do_nothing, rows that would violate a unique constraint are skipped: by the
+        database on PostgreSQL and SQLite, and by looking their unique columns up beforehand on other databases, which
+        does not guard against rows inserted concurrently. Returns the ids of the inserted rows.
+        """
+        rows = cls._get_rows(rows)
+        if not rows:
+            return []
+        dialect = session.get_bind().dialect
+        if dialect.name == 'postgresql':
+            statement = postgresql.insert(cls.__table__)
+        elif dialect.name == 'sqlite':
+            statement = sqlite.insert(cls.__table__)
+        else:
+            statement = insert(cls.__table__)
+        if on_conflict_do_nothing and dialect.name in ('postgresql', 'sqlite'):
+            statement = statement.on_conflict_do_nothing()
+        ids = []
+        try:
+            if on_conflict_do_nothing and dialect.name not in ('postgresql', 'sqlite'):
+                rows = cls._drop_conflicting_rows(session, rows)
+            if dialect.insert_executemany_returning:
+                # executemany with RETURNING is sent as multi-row VALUES batches by the driver
+                statement = statement.returning(cls.__table__.c.id)
+                for start in range(0, len(rows), cls._bulk_insert_batch_size):
+                    ids += session.scalars(statement, rows[start:start + cls._bulk_insert_batch_size]).all()
+            else:
+                # without RETURNING on executemany, the ids are only known when rows are inserted one at a time
+                for row in rows:
+                    ids.append(session.execute(statement, row).inserted_primary_key[0])
+            if commit:
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        return ids
+
+    @classmethod
+    def get_by_ids(cls, session: Session, ids: Iterable[int]) -> list[BaseSQLModel]:
+        ids = list(ids)
+        objects = []
+        for start in range(0, len(ids), cls._unique_lookup_batch_size):
+            objects += session.exec(select(cls).where(cls.id.in_(ids[start:start + cls._unique_lookup_batch_size])))
+        return objects
+
     @classmethod
     def mock(cls) -> BaseSQLModel:
         raise NotImplemented()
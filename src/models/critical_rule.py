@@ -3,13 +3,16 @@ from __future__ import annotations
 import random
 from datetime import datetime, timedelta
 
+from typing import Iterable, Any, Union, Annotated
+
 from faker import Faker
-from pydantic import model_validator
-from sqlalchemy import Column
-from sqlmodel import Field, Enum as SQLModelEnum, SQLModel
+from pydantic import model_validator, Field as PydanticField
+from sqlalchemy import Column, Index
+from sqlmodel import Field, Enum as SQLModelEnum, Session
 
 from src.models.base import BaseOutModel, BaseUpdateModel, BaseSQLModel, BaseModel
 from src.models.enums import Action
+from src.models.fingerprint import rule_fingerprint, rule_content, keep_fingerprint_updated
 
 
 MIN_PORT_NUMBER = 0
@@ -40,9 +43,12 @@ class CriticalRuleOutModel(CriticalRuleBaseModel, BaseOutModel):
     pass
 
 
-class GetAllCriticalRules(SQLModel):
+class GetAllCriticalRules(BaseModel):
     total: int
-    data: list[CriticalRuleOutModel]
+    # rows hold only the requested fields when the list is projected. Projected rows are tried first and kept as
+    # they are: a smart union would turn them into full out models, filling the missing fields with defaults
+    data: Annotated[Union[list[dict[str, Any]], list[CriticalRuleOutModel]], PydanticField(union_mode='left_to_right')]
+    next_cursor: int | None = None
 
 
 class CriticalRuleUpdateModel(CriticalRuleBaseModel, BaseUpdateModel, table=False):
@@ -51,6 +57,23 @@ class CriticalRuleUpdateModel(CriticalRuleBaseModel, BaseUpdateModel, table=Fals
 
 
 class CriticalRule(CriticalRuleOutModel, BaseSQLModel, table=True):
+    __table_args__ = (
+        Index('ix_criticalrule_protocol_dst_port', 'protocol', 'dst_port'),
+        Index('ix_criticalrule_created_at', 'created_at'),
+    )
+
+    # hash of the rule content; not unique, since critical rules with different titles may protect the same traffic
+    fingerprint: str | None = Field(default=None, index=True)
+
+    def compute_fingerprint(self) -> str:
+        return rule_fingerprint(rule_content(self))
+
+    @classmethod
+    def bulk_create(cls, session: Session, iterable: Iterable[CriticalRule], commit: bool = True) -> bool:
+        iterable = list(iterable)
+        for rule in iterable:
+            rule.fingerprint = rule.compute_fingerprint()
+        return super().bulk_create(session, iterable, commit=commit)
 
     @classmethod
     def mock(cls) -> CriticalRule:
@@ -81,3 +104,6 @@ class CriticalRule(CriticalRuleOutModel, BaseSQLModel, table=True):
         return CriticalRule(
             action=action, protocol=protocol, src_address=src_address, des_address=des_address, src_port=src_port,
             dst_port=des_port, title=title, description=description, start_time=start_time, end_time=end_time)
+
+
+keep_fingerprint_updated(CriticalRule)
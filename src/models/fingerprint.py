@@ -0,0 +1,54 @@
+import hashlib
+from typing import Any, Mapping
+
+from sqlalchemy import event
+
+from src.models.enums import Action
+
+# (min, max) pairs of the flow features a rule matches on
+RANGE_FIELDS = [
+    ('min_fl_byt_s', 'max_fl_byt_s'),
+    ('min_fl_pkt_s', 'max_fl_pkt_s'),
+    ('min_tot_fw_pk', 'max_tot_fw_pk'),
+    ('min_tot_bw_pk', 'max_tot_bw_pk'),
+]
+
+# fields that define what a rule matches and what it does
+RULE_CONTENT_FIELDS = ['protocol', 'dst_port', *(field for fields in RANGE_FIELDS for field in fields), 'action']
+
+
+def _canonical_value(field: str, value: Any) -> str:
+    if value is None:
+        return ''
+    if field == 'protocol':
+        return str(value).lower()
+    if field == 'action':
+        return Action(value).value
+    # bounds are quantized to 9 significant digits, so 5, 5.0, numpy scalars and float noise give the same bound
+    return format(float(value), '.9g')
+
+
+def rule_fingerprint(values: Mapping[str, Any]) -> str:
+    """
+    Hash of the canonical form of a rule's content, so that two rows matching the same traffic with the same action
+    share a fingerprint regardless of how their values were typed.
+    """
+    canonical = '|'.join(_canonical_value(field, values.get(field)) for field in RULE_CONTENT_FIELDS)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def rule_content(rule: Any) -> dict[str, Any]:
+    # read through the attributes rather than __dict__, which lacks the attributes expired by a commit
+    return {field: getattr(rule, field) for field in RULE_CONTENT_FIELDS}
+
+
+def keep_fingerprint_updated(model: type):
+    """
+    Recomputes the fingerprint column of a rule model whenever one of its rows is inserted or updated through the ORM.
+    Bulk paths that bypass the ORM events must set it themselves.
+    """
+    def set_fingerprint(mapper, connection, target):
+        target.fingerprint = rule_fingerprint(rule_content(target))
+
+    event.listen(model, 'before_insert', set_fingerprint)
+    event.listen(model, 'before_update', set_fingerprint)
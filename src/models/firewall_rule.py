@@ -1,14 +1,17 @@
 from __future__ import annotations
 
 import random
+from typing import Iterable, Mapping, Any, Union, Annotated
 
 from faker import Faker
-from sqlalchemy import Column
-from sqlmodel import Field, Enum as SQLModelEnum
+from pydantic import Field as PydanticField
+from sqlalchemy import Column, Index
+from sqlmodel import Field, Enum as SQLModelEnum, Session
 
 from src.common.notification import NotifiableObject
 from src.models.base import BaseUpdateModel, BaseOutModel, BaseSQLModel, BaseModel
 from src.models.enums import Action
+from src.models.fingerprint import rule_fingerprint, rule_content, keep_fingerprint_updated
 
 
 class FirewallRuleBaseModel(BaseModel, table=False):
@@ -39,10 +42,44 @@ class FirewallRuleOutModel(FirewallRuleBaseModel, BaseOutModel, NotifiableObject
 
 class GetAllFirewallRules(BaseModel):
     total: int
-    data: list[FirewallRuleOutModel]
+    # rows hold only the requested fields when the list is projected. Projected rows are tried first and kept as
+    # they are: a smart union would turn them into full out models, filling the missing fields with defaults
+    data: Annotated[Union[list[dict[str, Any]], list[FirewallRuleOutModel]], PydanticField(union_mode='left_to_right')]
+    next_cursor: int | None = None
 
 
 class FirewallRule(FirewallRuleOutModel, BaseSQLModel, table=True):
+    __table_args__ = (
+        # rules are grouped, deduplicated and filtered by protocol and port
+        Index('ix_firewallrule_protocol_dst_port', 'protocol', 'dst_port'),
+        Index('ix_firewallrule_created_at', 'created_at'),
+    )
+
+    # hash of the rule content: the unique index makes the database drop repeated rules on insert
+    fingerprint: str | None = Field(default=None, index=True, unique=True)
+
+    def compute_fingerprint(self) -> str:
+        return rule_fingerprint(rule_content(self))
+
+    @classmethod
+    def bulk_create(cls, session: Session, iterable: Iterable[FirewallRule], commit: bool = True) -> bool:
+        iterable = list(iterable)
+        for rule in iterable:
+            rule.fingerprint = rule.compute_fingerprint()
+        return super().bulk_create(session, iterable, commit=commit)
+
+    @classmethod
+    def bulk_insert(cls, session: Session, rows: Iterable[FirewallRule | Mapping[str, Any]] | Any,
+                    on_conflict_do_nothing: bool = True, commit: bool = True) -> list[int]:
+        """
+        Inserts rules that are not in the table yet, skipping those whose fingerprint already exists. Returns the ids
+        of the inserted rules.
+        """
+        rows = cls._get_rows(rows)
+        for row in rows:
+            row['action'] = Action(row['action'])
+            row['fingerprint'] = rule_fingerprint(row)
+        return super().bulk_insert(session, rows, on_conflict_do_nothing=on_conflict_do_nothing, commit=commit)
 
     @classmethod
     def mock(cls) -> FirewallRule:
@@ -59,3 +96,6 @@ class FirewallRule(FirewallRuleOutModel, BaseSQLModel, table=True):
         return FirewallRule(
             action=action, protocol=protocol, src_address=src_address, des_address=des_address,
             src_port=src_port, dst_port=des_port)
+
+
+keep_fingerprint_updated(FirewallRule)
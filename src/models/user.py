@@ -1,20 +1,22 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime
 
-import bcrypt
 from faker import Faker
-from sqlmodel import Session, SQLModel
+from sqlalchemy import or_, case
+from sqlmodel import Session, Field
 
 from src.common.config import ConfigurationManager
+from src.common.password import PasswordHashingPool
 from src.common.exceptions.auth import LoginTriesLimitExceeded, IncorrectCredentialsException, UserInactiveException, \
     InvalidPasswordException
 from src.models.base import BaseUpdateModel, BaseOutModel, BaseSQLModel, BaseModel
 
 
 class UserBaseModel(BaseModel):
-    username: str
-    email: str
+    username: str = Field(index=True)
+    email: str = Field(index=True)
     first_name: str
     last_name: str
     active: bool
@@ -40,9 +42,10 @@ class UserOutModel(UserBaseModel, BaseOutModel):
     login_attempts: int = 0
 
 
-class GetAllUsers(SQLModel):
+class GetAllUsers(BaseModel):
     total: int
     data: list[User]
+    next_cursor: int | None = None
 
 
 class User(UserOutModel, BaseSQLModel, table=True):
@@ -89,27 +92,40 @@ class User(UserOutModel, BaseSQLModel, table=True):
 
     @staticmethod
     def hash_password(password: str) -> str:
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
-        return hashed_password.decode('utf-8')
+        return PasswordHashingPool().hash_password(password)
 
     def check_password(self, password: str) -> bool:
-        return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
+        return PasswordHashingPool().check_password(password, self.password_hash)
 
     # noinspection PyTypeChecker
     @staticmethod
     def get_by_username_or_email(session: Session, identifier: str):
-        user = session.query(User).filter(User.email == identifier).first()
-        if user is not None:
-            return user
-        return session.query(User).filter(User.username == identifier).first()
+        # a single query over both indexes, where a match by email still takes precedence over one by username
+        return (session.query(User).filter(or_(User.email == identifier, User.username == identifier))
+                .order_by(case((User.email == identifier, 0), else_=1)).first())
 
     @classmethod
     def authenticate(cls, session: Session, identifier: str, password: str) -> User:
         user = cls.get_by_username_or_email(session, identifier)
         if user is None:
             raise IncorrectCredentialsException()
-        if user.active and not user.check_password(password):
+        # the password of an inactive user is not checked
+        password_matches = user.active and user.check_password(password)
+        return cls._register_login_attempt(session, user, password_matches)
+
+    @classmethod
+    async def authenticate_async(cls, session: Session, identifier: str, password: str) -> User:
+        # database work runs in a worker thread and bcrypt on the hashing pool, so the event loop is never blocked
+        user = await asyncio.to_thread(cls.get_by_username_or_email, session, identifier)
+        if user is None:
+            raise IncorrectCredentialsException()
+        password_matches = user.active and await PasswordHashingPool().check_password_async(
+            password, user.password_hash)
+        return await asyncio.to_thread(cls._register_login_attempt, session, user, password_matches)
+
+    @classmethod
+    def _register_login_attempt(cls, session: Session, user: User, password_matches: bool) -> User:
+        if user.active and not password_matches:
             user.login_attempts += 1
             login_configs = ConfigurationManager().get_server_config().authentication.login
             if user.login_attempts > login_configs.max_login_tries:
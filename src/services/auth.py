@@ -1,4 +1,8 @@
-from datetime import timedelta, datetime
+import asyncio
+from collections import OrderedDict
+from datetime import timedelta, datetime, timezone
+from threading import Lock
+from time import monotonic
 from typing import Annotated, Type
 
 from jose import jwt, JWTError
@@ -9,12 +13,12 @@ from sqlmodel import Session
 from starlette.status import HTTP_401_UNAUTHORIZED
 
 from src.common.auth import TokenAuthService
-from src.common.config import InjectedTokenConfig, AuthConfig, ConfigurationManager
+from src.common.config import AuthConfig, ConfigurationManager
 from src.common.exceptions.auth import AuthenticationServiceNotLoadedException, UnknownAuthenticationService, \
     AuthException
 from src.common.singleton import LoadableSingleton
 from src.models.user import UserOutModel, User
-from src.services.database import InjectedSession
+from src.services.database import DBSessionManager
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
 
@@ -38,18 +42,87 @@ class JWTAuthService(TokenAuthService):
         except (JWTError, ValidationError):
             return None
 
+    def get_expiration(self, token: str) -> datetime | None:
+        # only called on tokens that have already been verified
+        exp = jwt.get_unverified_claims(token).get('exp')
+        return datetime.fromtimestamp(exp, tz=timezone.utc) if exp is not None else None
+
+
+class TokenUserCache:
+    """
+    Bounded LRU cache of verified token -> user snapshot, so that requests carrying a known token are authenticated
+    without querying the database. Entries live for at most ttl_seconds, and never beyond the expiration of their
+    token.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = Lock()
+        self._entries: OrderedDict[str, tuple[float, UserOutModel]] = OrderedDict()
+        self._tokens_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> UserOutModel | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if monotonic() >= expires_at:
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return user
+
+    def put(self, token: str, user: UserOutModel, token_expiration: datetime | None = None):
+        ttl_seconds = self.ttl_seconds
+        if token_expiration is not None:
+            ttl_seconds = min(ttl_seconds, (token_expiration - datetime.now(timezone.utc)).total_seconds())
+        if ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (monotonic() + ttl_seconds, user)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_tokens = self._tokens_by_user.get(entry[1].id)
+        if user_tokens is not None:
+            user_tokens.discard(token)
+            if not user_tokens:
+                del self._tokens_by_user[entry[1].id]
+
 
 class TokenAuthManager(LoadableSingleton):
 
     def __init__(self):
         self._config: AuthConfig | None = None
         self._service: Type[TokenAuthService] | None = None
+        self._user_cache: TokenUserCache | None = None
         super().__init__()
 
     def _load(self):
         self._config = ConfigurationManager().get_auth_config()
         if self._config is None:
             return
+        if self._config.cache.enable:
+            self._user_cache = TokenUserCache(
+                max_size=self._config.cache.max_size, ttl_seconds=self._config.cache.ttl_seconds)
         if self._config.login.method == "JWTAuthService":
             self._service = JWTAuthService
         else:
@@ -69,13 +142,41 @@ class TokenAuthManager(LoadableSingleton):
     def generate_token(self, user: User, session: Session, config: AuthConfig.TokenConfig):
         return self.get_service(session, config).generate_token(user)
 
-    def authenticate_token(self, token: str, session: Session, config: AuthConfig.TokenConfig):
-        return self.get_service(session, config).authenticate_token(token)
-
-
-def get_current_user(
-        token: Annotated[str, Depends(oauth2_scheme)], session: InjectedSession, config: InjectedTokenConfig):
-    current_user = TokenAuthManager().authenticate_token(token, session, config)
+    def get_cached_user(self, token: str) -> UserOutModel | None:
+        with self.load_guard():
+            return self._user_cache.get(token) if self._user_cache is not None else None
+
+    def authenticate_token(self, token: str, session: Session, config: AuthConfig.TokenConfig) -> UserOutModel | None:
+        user = self.get_cached_user(token)
+        if user is not None:
+            return user
+        service = self.get_service(session, config)
+        user = service.authenticate_token(token)
+        if user is None or self._user_cache is None:
+            return user
+        # a detached snapshot, since the session the user was loaded from is closed after the request
+        snapshot = UserOutModel.model_validate(user)
+        self._user_cache.put(token, snapshot, token_expiration=service.get_expiration(token))
+        return snapshot
+
+    def invalidate_user(self, user_id: int):
+        # called whenever a user changes, so that requests of that user are authenticated against the database again
+        if self._user_cache is not None:
+            self._user_cache.invalidate_user(user_id)
+
+
+def _authenticate_uncached_token(token: str) -> UserOutModel | None:
+    with DBSessionManager().get_session() as session:
+        return TokenAuthManager().authenticate_token(
+            token, session, ConfigurationManager().get_server_config().authentication.token)
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> UserOutModel:
+    # a cached token is resolved on the event loop: only a cache miss checks a session out of the pool, in a worker
+    # thread since the lookup blocks
+    current_user = TokenAuthManager().get_cached_user(token)
+    if current_user is None:
+        current_user = await asyncio.to_thread(_authenticate_uncached_token, token)
     if current_user is None:
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
@@ -88,7 +189,7 @@ def get_current_user(
 InjectedCurrentUser = Annotated[UserOutModel, Depends(get_current_user)]
 
 
-def user_is_logged_in_dependency(current_user: InjectedCurrentUser):
+async def user_is_logged_in_dependency(current_user: InjectedCurrentUser):
     if not current_user:
         raise AuthException('Not Authenticated')
     return current_user
@@ -1,23 +1,110 @@
-from typing import Iterator, Annotated
+from threading import Lock
+from time import perf_counter, monotonic
+from typing import Iterator, Annotated, AsyncIterator, TypeVar, Sequence, Any
 
 from fastapi import Depends
-from sqlmodel import create_engine, Session, SQLModel
+from pydantic import BaseModel
+from sqlalchemy import event, AsyncAdaptedQueuePool, text, ColumnElement
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from sqlmodel import create_engine, Session, SQLModel, select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.common.config import ConfigurationManager, DbConfig
 from src.common.exceptions.db import DbManagerNotLoadedException
 from src.common.singleton import LoadableSingleton
 
+T = TypeVar('T', bound=SQLModel)
+
+
+class PoolMetrics(BaseModel):
+    pool_size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    total_connects: int
+    total_checkouts: int
+    total_invalidations: int
+    # time connections were held between checkout and checkin
+    avg_checkout_seconds: float
+    max_checkout_seconds: float
+
+
+class PoolMetricsCollector:
+    def __init__(self):
+        self._lock = Lock()
+        self.total_connects = 0
+        self.total_checkouts = 0
+        self.total_checkins = 0
+        self.total_invalidations = 0
+        self.total_checkout_seconds = 0.
+        self.max_checkout_seconds = 0.
+
+    def attach(self, engine):
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.total_connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out_at'] = perf_counter()
+        with self._lock:
+            self.total_checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is None:
+            return
+        held_seconds = perf_counter() - checked_out_at
+        with self._lock:
+            self.total_checkins += 1
+            self.total_checkout_seconds += held_seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, held_seconds)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.total_invalidations += 1
+
+    def snapshot(self, pool) -> PoolMetrics:
+        with self._lock:
+            return PoolMetrics(
+                pool_size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                overflow=pool.overflow(), total_connects=self.total_connects, total_checkouts=self.total_checkouts,
+                total_invalidations=self.total_invalidations,
+                avg_checkout_seconds=self.total_checkout_seconds / self.total_checkins if self.total_checkins else 0.,
+                max_checkout_seconds=self.max_checkout_seconds)
+
 
 class DBSessionManager(LoadableSingleton):
+    # drivers used by the async engine for each dbms, when db config does not set asyncDbms
+    _async_drivers = {
+        'postgresql': 'postgresql+asyncpg',
+        'sqlite': 'sqlite+aiosqlite',
+    }
 
     def __init__(self):
         self._config: DbConfig | None = None
         self._engine = None
+        self._async_engine: AsyncEngine | None = None
+        self._async_engine_lock = Lock()
+        self._pool_metrics = PoolMetricsCollector()
+        self._async_pool_metrics = PoolMetricsCollector()
+        # exact counts of large tables, by table name, with the time they were taken
+        self._count_cache: dict[str, tuple[float, int]] = {}
         super().__init__()
 
     def _load(self):
         self._config = ConfigurationManager().get_database_config()
-        self._engine = create_engine(self.get_uri(), echo=self._config.verbose)
+        self._engine = create_engine(
+            self.get_uri(),
+            # echo logs every statement synchronously, so it is meant for debugging only
+            echo=self._config.verbose,
+            connect_args=self._get_connect_args(),
+            **self._get_pool_args())
+        self._pool_metrics.attach(self._engine)
 
     def _loaded(self) -> bool:
         return self._config is not None and self._engine is not None
@@ -25,20 +112,157 @@ class DBSessionManager(LoadableSingleton):
     def _not_loaded_exception(self) -> Exception:
         return DbManagerNotLoadedException()
 
-    def get_uri(self) -> str:
-        return (f'{self._config.dbms}://{self._config.user}:{self._config.password}@'
+    def get_uri(self, dbms: str | None = None) -> str:
+        dbms = dbms or self._config.dbms
+        if dbms.startswith('sqlite'):
+            # sqlite databases are files, named after the database
+            return f'{dbms}:///{self._config.name}'
+        return (f'{dbms}://{self._config.user}:{self._config.password}@'
                 f'{self._config.host}:{self._config.port}/{self._config.name}')
 
+    def get_async_dbms(self) -> str:
+        if self._config.async_dbms is not None:
+            return self._config.async_dbms
+        dialect = self._config.dbms.split('+')[0]
+        if dialect not in self._async_drivers:
+            raise ValueError(f"no async driver known for {self._config.dbms}: set asyncDbms in the database config")
+        return self._async_drivers[dialect]
+
+    def _get_pool_args(self) -> dict:
+        return dict(
+            pool_size=self._config.pool_size,
+            max_overflow=self._config.max_overflow,
+            pool_timeout=self._config.pool_timeout_seconds,
+            pool_recycle=self._config.pool_recycle_seconds,
+            pool_pre_ping=self._config.pool_pre_ping)
+
+    def _get_connect_args(self) -> dict:
+        if self._config.statement_timeout_ms is not None and self._config.dbms.startswith('postgresql'):
+            # applied by the server to every statement of the connection
+            return {'options': f'-c statement_timeout={self._config.statement_timeout_ms}'}
+        return {}
+
+    def _get_async_connect_args(self) -> dict:
+        if self._config.statement_timeout_ms is not None and self.get_async_dbms().startswith('postgresql+asyncpg'):
+            return {'server_settings': {'statement_timeout': str(self._config.statement_timeout_ms)}}
+        return {}
+
+    def _get_async_engine(self) -> AsyncEngine:
+        # created on first use, so that processes which only use the sync engine do not need the async driver
+        with self._async_engine_lock:
+            if self._async_engine is None:
+                self._async_engine = create_async_engine(
+                    self.get_uri(self.get_async_dbms()),
+                    echo=self._config.verbose,
+                    connect_args=self._get_async_connect_args(),
+                    # aiosqlite defaults to a NullPool, which takes no sizing arguments
+                    poolclass=AsyncAdaptedQueuePool,
+                    **self._get_pool_args())
+                self._async_pool_metrics.attach(self._async_engine.sync_engine)
+            return self._async_engine
+
     def get_session(self) -> Session:
+        """
+        Returns a new session, which must be closed by the caller to give its connection back to the pool, e.g. by
+        using it as a context manager.
+        """
         with self.load_guard():
             return Session(self._engine)
 
+    def get_async_session(self) -> AsyncSession:
+        """
+        Async counterpart of get_session, for queries that must not block the event loop. Objects are not expired on
+        commit, since reloading their attributes lazily is not possible outside of an await.
+        """
+        with self.load_guard():
+            return AsyncSession(self._get_async_engine(), expire_on_commit=False)
+
+    def get_pool_metrics(self) -> PoolMetrics:
+        with self.load_guard():
+            return self._pool_metrics.snapshot(self._engine.pool)
+
+    def get_async_pool_metrics(self) -> PoolMetrics:
+        with self.load_guard():
+            return self._async_pool_metrics.snapshot(self._get_async_engine().pool)
+
+    async def count_rows(self, session: AsyncSession, model: type[SQLModel]) -> int:
+        """
+        Number of rows of the model's table. Tables with at least exactCountThreshold rows get an estimate: the
+        planner statistics on PostgreSQL, or an exact count reused for countCacheSeconds on other databases. Smaller
+        tables are always counted exactly, which is cheap for them.
+        """
+        table = model.__tablename__
+        threshold = self._config.exact_count_threshold
+        if session.bind.dialect.name == 'postgresql':
+            # reltuples is kept up to date by autovacuum, and is negative for tables never analyzed
+            estimate = (await session.execute(
+                text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)'),
+                {'table': table})).scalar_one_or_none()
+            if estimate is not None and estimate >= threshold:
+                return estimate
+        elif table in self._count_cache:
+            counted_at, count = self._count_cache[table]
+            if monotonic() - counted_at < self._config.count_cache_seconds:
+                return count
+        count = (await session.exec(select(func.count()).select_from(model))).one()
+        if count >= threshold:
+            self._count_cache[table] = (monotonic(), count)
+        else:
+            self._count_cache.pop(table, None)
+        return count
+
     def create_db_and_tables(self):
         SQLModel.metadata.create_all(self._engine)
 
 
 def get_session() -> Iterator[Session]:
-    yield DBSessionManager().get_session()
+    # the session is closed once the response has been sent, returning its connection to the pool
+    with DBSessionManager().get_session() as session:
+        yield session
 
 
 InjectedSession = Annotated[Session, Depends(get_session)]
+
+
+async def get_async_session() -> AsyncIterator[AsyncSession]:
+    async with DBSessionManager().get_async_session() as session:
+        yield session
+
+
+InjectedAsyncSession = Annotated[AsyncSession, Depends(get_async_session)]
+
+
+async def get_page(session: AsyncSession, model: type[T], page: int, page_size: int | None,
+                   after: int | None = None, filters: Sequence[ColumnElement[bool]] = (),
+                   columns: Sequence[str] | None = None) -> tuple[list[T] | list[dict[str, Any]], int, int | None]:
+    """
+    Returns a page of rows ordered by id, the total number of rows and the cursor of the next page. When after is
+    given, the page starts right after the row of that id, which an index seek finds at any depth; otherwise the
+    page is found by skipping page * page_size rows. Only rows matching every filter are returned, and the total
+    counts only those. With columns, rows are dicts holding the id and those columns alone.
+    """
+    if columns is None:
+        query = select(model)
+    else:
+        query = select(model.id, *(getattr(model, column) for column in columns if column != 'id'))
+    query = query.where(*filters).order_by(model.id)
+    if after is not None:
+        query = query.where(model.id > after)
+    elif page_size is not None:
+        query = query.offset(page * page_size)
+    if page_size is not None:
+        query = query.limit(page_size)
+    if columns is None:
+        rows = (await session.exec(query)).all()
+    else:
+        rows = [dict(row._mapping) for row in (await session.exec(query)).all()]
+    if filters:
+        # estimates only exist for whole tables
+        total = (await session.exec(select(func.count()).select_from(model).where(*filters))).one()
+    else:
+        total = await DBSessionManager().count_rows(session, model)
+    # a short page is the last one
+    next_cursor = None
+    if rows and page_size is not None and len(rows) == page_size:
+        next_cursor = rows[-1]['id'] if columns is not None else rows[-1].id
+    return rows, total, next_cursor
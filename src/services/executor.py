@@ -1,12 +1,22 @@
+import asyncio
+import os
+import stat
 import subprocess
 from abc import ABC, abstractmethod
+from pathlib import Path
+from tempfile import gettempdir
+from threading import BoundedSemaphore
 
 
 class CommandExecutor(ABC):
     @abstractmethod
-    def execute(self, command: str) -> str:
+    def execute(self, command: str, input: str | None = None) -> str:
         ...
 
+    async def execute_async(self, command: str, input: str | None = None) -> str:
+        # commands block on a child process, so they run in a worker thread to keep the event loop free
+        return await asyncio.to_thread(self.execute, command, input)
+
 
 class LocalLinuxExecutor(CommandExecutor):
     def __init__(self, password: str | None = None, admin: bool = False):
@@ -15,30 +25,98 @@ class LocalLinuxExecutor(CommandExecutor):
         self.admin = admin
         self.password = password
 
-    def execute(self, command):
-        if self.admin:
-            command = f"echo '{self.password}' | sudo -S {command}"
+    def execute(self, command, input=None):
+        if self.admin and input is not None:
+            # sudo reads the password from the first line of stdin and hands the rest over to the command. -k makes it
+            # ignore cached credentials, so it always consumes that line instead of passing it on to the command
+            command = f"sudo -k -S -p '' {command}"
+            input = f"{self.password}\n{input}"
+        elif self.admin:
+            command = f"echo '{self.password}' | sudo -k -S -p '' {command}"
         try:
-            result = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
+            result = subprocess.check_output(
+                command, shell=True, stderr=subprocess.STDOUT, input=input.encode() if input is not None else None)
             return result.decode()
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"Failed to execute local command: {e.output.decode()}")
 
 
 class SSHExecutor(CommandExecutor):
-    def __init__(self, ssh_host, ssh_user, ssh_key_path):
+    # ssh exits with 255 when the connection itself fails, e.g. when a master connection went stale
+    _connection_error_code = 255
+
+    def __init__(self, ssh_host, ssh_user, ssh_key_path, control_persist_seconds: int = 600,
+                 max_concurrent_commands: int = 8, timeout_seconds: float | None = None):
         self.ssh_host = ssh_host
         self.ssh_user = ssh_user
         self.ssh_key_path = ssh_key_path
+        self.control_persist_seconds = control_persist_seconds
+        self.timeout_seconds = timeout_seconds
+        # sshd limits the sessions multiplexed over a single connection (MaxSessions, 10 by default)
+        self._semaphore = BoundedSemaphore(max_concurrent_commands)
+        self._control_dir = self._get_control_dir()
 
-    def execute(self, command):
-        ssh_command = [
-            'ssh', '-i', self.ssh_key_path,
-            f'{self.ssh_user}@{self.ssh_host}',
-            command
-        ]
+    @staticmethod
+    def _get_control_dir() -> Path:
+        # control sockets grant access to the authenticated connection, so they live in a directory only this user
+        # can reach. A directory someone else created first, or opened up, is refused rather than reused
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        control_dir = Path(runtime_dir) / 'fw-ips-ssh' if runtime_dir else \
+            Path(gettempdir()) / f'fw-ips-ssh-{os.getuid()}'
         try:
-            result = subprocess.check_output(ssh_command, stderr=subprocess.STDOUT)
-            return result.decode()
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to execute remote command: {e.output.decode()}")
+            control_dir.mkdir(mode=0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(control_dir)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+            raise RuntimeError(f"SSH control directory {control_dir} must be a directory owned by the current user "
+                               f"and accessible only by them")
+        return control_dir
+
+    @property
+    def _destination(self) -> str:
+        return f'{self.ssh_user}@{self.ssh_host}'
+
+    @property
+    def _control_options(self) -> list[str]:
+        # every command is multiplexed over one long-lived authenticated connection per host, which is opened by the
+        # first command and kept open for control_persist_seconds after the last one
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={self._control_dir / "%C"}',
+            '-o', f'ControlPersist={self.control_persist_seconds}',
+        ]
+
+    def _run(self, command: str, input: str | None) -> str:
+        ssh_command = ['ssh', '-i', self.ssh_key_path, *self._control_options, self._destination, command]
+        result = subprocess.check_output(
+            ssh_command, stderr=subprocess.STDOUT, input=input.encode() if input is not None else None,
+            timeout=self.timeout_seconds)
+        return result.decode()
+
+    def _master_is_alive(self) -> bool:
+        return subprocess.run(['ssh', *self._control_options, '-O', 'check', self._destination],
+                              capture_output=True).returncode == 0
+
+    def execute(self, command, input=None):
+        with self._semaphore:
+            try:
+                return self._run(command, input)
+            except subprocess.CalledProcessError as e:
+                # a remote command may also exit with 255, possibly after applying part of its work: it is only run
+                # again when the master connection is confirmed to be down
+                if e.returncode != self._connection_error_code or self._master_is_alive():
+                    raise RuntimeError(f"Failed to execute remote command: {e.output.decode()}")
+            except subprocess.TimeoutExpired:
+                raise RuntimeError(f"Remote command timed out after {self.timeout_seconds}s on {self.ssh_host}")
+            # drop the broken master connection and try once more over a new one
+            self.close()
+            try:
+                return self._run(command, input)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"Failed to execute remote command: {e.output.decode()}")
+            except subprocess.TimeoutExpired:
+                raise RuntimeError(f"Remote command timed out after {self.timeout_seconds}s on {self.ssh_host}")
+
+    def close(self):
+        subprocess.run(['ssh', *self._control_options, '-O', 'exit', self._destination], capture_output=True)
@@ -1,9 +1,21 @@
+import asyncio
+import logging
+import math
+import re
+import shlex
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable, Callable, TypeVar
 
+import numpy as np
+
+from src.common.exceptions.firewall import FirewallHostsFailedException
 from src.models.enums import Action
 from src.models.firewall_rule import FirewallRule
 from src.services.executor import CommandExecutor
 
+T = TypeVar('T')
+
 
 class FirewallWriter(ABC):
     @abstractmethod
@@ -18,6 +30,16 @@ class FirewallWriter(ABC):
     def delete_rule(self, rule: FirewallRule):
         ...
 
+    @abstractmethod
+    def apply_batch(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        """
+        Deletes and appends rules in a single transaction: either every change is applied or none is.
+        """
+        ...
+
+    async def apply_batch_async(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        await asyncio.to_thread(self.apply_batch, list(adds), list(deletes))
+
     @abstractmethod
     def flush(self):
         ...
@@ -26,6 +48,37 @@ class FirewallWriter(ABC):
     def list_rules(self) -> list[FirewallRule]:
         ...
 
+    @abstractmethod
+    def rule_key(self, rule: FirewallRule) -> str:
+        """
+        Canonical representation of a rule in this firewall: two rules with the same key are the same firewall rule.
+        """
+        ...
+
+    def sync_rules(self, rules: Iterable[FirewallRule]) -> tuple[int, int]:
+        """
+        Makes the firewall hold exactly the given rules, applying only the difference to the rules it currently holds
+        in a single batch. Returns the number of added and deleted rules.
+        """
+        adds, deletes = self._diff_rules(rules, [(rule, rule) for rule in self.list_rules()])
+        if adds or deletes:
+            self.apply_batch(adds=adds, deletes=deletes)
+        return len(adds), len(deletes)
+
+    def _diff_rules(self, rules: Iterable[FirewallRule], current: Iterable[tuple[FirewallRule, T]]) \
+            -> tuple[list[FirewallRule], list[T]]:
+        """
+        Returns the wanted rules missing from the current ones, and what stands for each current rule that has to go.
+        """
+        wanted = {self.rule_key(rule): rule for rule in rules}
+        current_by_key: dict[str, list[T]] = {}
+        for rule, handle in current:
+            current_by_key.setdefault(self.rule_key(rule), []).append(handle)
+        adds = [rule for key, rule in wanted.items() if key not in current_by_key]
+        # repeated copies of a wanted rule are removed as well, keeping a single one
+        deletes = [handle for key, copies in current_by_key.items() for handle in copies[1 if key in wanted else 0:]]
+        return adds, deletes
+
 
 class IPTablesWriter(FirewallWriter):
     def __init__(self, command_executor: CommandExecutor, chain: str, table: str):
@@ -40,6 +93,8 @@ class IPTablesWriter(FirewallWriter):
         if not rule.protocol and (rule.dst_port):
             raise ValueError("port must specify a protocol")
         # write protocol, source and destiny
+        if rule.protocol:
+            rule_str += f"-p {rule.protocol.lower()} "
         if rule.protocol and rule.dst_port:
             rule_str += f"--dport {rule.dst_port} "
 
@@ -62,41 +117,123 @@ class IPTablesWriter(FirewallWriter):
             rule_str += "-j REJECT"
         return rule_str.strip()
 
+    # options the reader understands in each match block, which are the ones _write_iptables_rule writes. Options
+    # before the first -m are in the block of the empty module ''
+    _read_options = {
+        '': {'-p', '--protocol', '--dport', '--destination-port'},
+        'tcp': {'--dport', '--destination-port'},
+        'udp': {'--dport', '--destination-port'},
+        'connbytes': {'--connbytes', '--connbytes-dir', '--connbytes-mode'},
+        'conntrack': {'--ctdir', '--ctbytes'},
+    }
+    # target options -S prints for the targets _write_iptables_rule writes, with the only value each may take
+    _read_target_options = {
+        'ACCEPT': {},
+        'REJECT': {'--reject-with': 'icmp-port-unreachable'},
+    }
+
+    @classmethod
+    def _tokenize_iptables_rule(cls, line: str) \
+            -> tuple[str | None, list[tuple[str, dict[str, str]]], str | None, dict[str, str]]:
+        """
+        Splits a rule as printed by `iptables -S` or `iptables-save` into its chain, its match blocks, its target and
+        the options of its target. Options before the first `-m` are kept in a block of their own, named after the
+        empty module ''. A negated option is kept under its name prefixed with '! ', e.g. '! --dport'.
+        """
+        tokens = shlex.split(line)
+        chain, target = None, None
+        blocks: list[tuple[str, dict[str, str]]] = [('', {})]
+        target_options: dict[str, str] = {}
+        negated = False
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            value = tokens[i + 1] if i + 1 < len(tokens) else None
+            if token == '!':
+                negated = True
+                i += 1
+                continue
+            if negated:
+                token, negated = f'! {token}', False
+            if token == '-A':
+                chain = value
+            elif token == '-m':
+                blocks.append((value, {}))
+            elif token == '-j':
+                target = value
+            elif target is not None:
+                target_options[token] = value
+            else:
+                blocks[-1][1][token] = value
+            i += 2
+        return chain, blocks, target, target_options
+
+    @staticmethod
+    def _read_range(value: str, cast: type) -> tuple:
+        lower, separator, upper = value.partition(':')
+        if separator and not upper:
+            # an open range, which rules never hold
+            raise ValueError(f"unbounded range {value}")
+        return cast(float(lower)), cast(float(upper or lower))
+
+    @classmethod
+    def _read_iptables_fields(cls, blocks: list[tuple[str, dict[str, str]]], target: str | None,
+                              target_options: dict[str, str]) -> dict | None:
+        # None when the rule holds anything FirewallRule cannot express, so it would not be written back the same
+        if target not in cls._read_target_options or any(
+                cls._read_target_options[target].get(option) != value for option, value in target_options.items()):
+            return None
+        fields = {'action': cls._translate_action(target)}
+
+        def read(names: tuple[str, ...], values: tuple) -> bool:
+            if any(name in fields for name in names):
+                return False
+            fields.update(zip(names, values))
+            return True
+
+        for module, options in blocks:
+            if not set(options) <= cls._read_options.get(module, set()):
+                return None
+            if '-p' in options or '--protocol' in options:
+                if not read(('protocol',), (options.get('-p', options.get('--protocol')),)):
+                    return None
+            if '--dport' in options or '--destination-port' in options:
+                port = options.get('--dport', options.get('--destination-port'))
+                if not (port.isdecimal() or port in cls._port_mappings) or \
+                        not read(('dst_port',), (cls._translate_port(port),)):
+                    return None
+            if module == 'connbytes':
+                mode = {'bytes': 'byt', 'packets': 'pkt'}.get(options.get('--connbytes-mode'))
+                if mode is None or options.get('--connbytes-dir') != 'both' or '--connbytes' not in options or \
+                        not read((f'min_fl_{mode}_s', f'max_fl_{mode}_s'),
+                                 cls._read_range(options['--connbytes'], float)):
+                    return None
+            if module == 'conntrack':
+                direction = {'ORIGINAL': 'fw', 'REPLY': 'bw'}.get(options.get('--ctdir'))
+                if direction is None or '--ctbytes' not in options or \
+                        not read((f'min_tot_{direction}_pk', f'max_tot_{direction}_pk'),
+                                 cls._read_range(options['--ctbytes'], int)):
+                    return None
+        return fields
+
     @classmethod
-    def _read_iptables_rule(cls, rules_str: str) -> list[FirewallRule]:
+    def _read_iptables_rule(cls, rules_str: str, chain: str | None = None) -> list[tuple[str, FirewallRule | None]]:
+        """
+        Reads the rules of a listing, each with the line it was read from. Rules holding options, negations or targets
+        that FirewallRule cannot express are returned as None, rather than as a different rule.
+        """
         rules = []
-        lines = rules_str.splitlines()
-        for line in lines:
-            if not line or line.startswith('target') or 'Chain' in line:
+        for line in rules_str.splitlines():
+            if not line.startswith('-A '):
                 continue
-            parts = line.split()
-            if len(parts) < 10:
+            rule_chain, blocks, target, target_options = cls._tokenize_iptables_rule(line)
+            if chain is not None and rule_chain != chain:
                 continue
-            dst_port=parts[1]
-            protocol= parts[2]
-            min_fl_byt_s=parts[3]
-            max_fl_byt_s=parts[4]
-            min_fl_pkt_s=parts[5]
-            max_fl_pkt_s=parts[6]
-            min_tot_fw_pk=parts[7]
-            max_tot_fw_pk=parts[8]
-            min_tot_bw_pk=parts[9]
-            max_tot_bw_pk=parts[10]
-            action = parts[0]
-            rule = FirewallRule(
-                protocol=protocol,
-                dst_port=dst_port,
-                min_fl_byt_s=min_fl_byt_s,
-                max_fl_byt_s=max_fl_byt_s,
-                min_fl_pkt_s=min_fl_pkt_s,
-                max_fl_pkt_s=max_fl_pkt_s,
-                min_tot_fw_pk=min_tot_fw_pk,
-                max_tot_fw_pk=max_tot_fw_pk,
-                min_tot_bw_pk=min_tot_bw_pk,
-                max_tot_bw_pk=max_tot_bw_pk,
-                action=action
-            )
-            rules.append(rule)
+            try:
+                fields = cls._read_iptables_fields(blocks, target, target_options)
+            except ValueError:
+                fields = None
+            rules.append((line, FirewallRule(**fields) if fields is not None else None))
         return rules
 
     _port_mappings = {
@@ -168,11 +305,527 @@ class IPTablesWriter(FirewallWriter):
         command = f"iptables -t {self.table} -D {self.chain} {self._write_iptables_rule(rule)}"
         self.command_executor.execute(command)
 
+    def _write_restore_script(self, adds: Iterable[FirewallRule], deletes: Iterable[FirewallRule],
+                              deleted_lines: Iterable[str] = ()) -> str:
+        lines = [f"*{self.table}"]
+        lines += [f"-D {self.chain} {self._write_iptables_rule(rule)}" for rule in deletes]
+        # rules listed by -S are deleted through the exact line they were listed as
+        lines += [f"-D {line.removeprefix('-A ')}" for line in deleted_lines]
+        lines += [f"-A {self.chain} {self._write_iptables_rule(rule)}" for rule in adds]
+        lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def apply_batch(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        # iptables-restore commits the whole table at once, so the chain is never left half-applied
+        script = self._write_restore_script(adds=adds, deletes=deletes)
+        self.command_executor.execute("iptables-restore --noflush", input=script)
+
+    async def apply_batch_async(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        script = self._write_restore_script(adds=adds, deletes=deletes)
+        await self.command_executor.execute_async("iptables-restore --noflush", input=script)
+
+    def rule_key(self, rule: FirewallRule) -> str:
+        return self._write_iptables_rule(rule)
+
     def flush(self):
         command = f"iptables -t {self.table} -F {self.chain}"
         self.command_executor.execute(command)
 
-    def list_rules(self) -> list[FirewallRule]:
-        command = f"iptables -t {self.table} -L {self.chain}"
+    def _list_chain(self) -> list[tuple[str, FirewallRule]]:
+        # -S prints rules in the same syntax they are written in, with numeric addresses and ports
+        command = f"iptables -t {self.table} -S {self.chain}"
         output = self.command_executor.execute(command)
-        return self._read_iptables_rule(rules_str=output)
+        rules = []
+        for line, rule in self._read_iptables_rule(rules_str=output, chain=self.chain):
+            if rule is None:
+                logging.warning(f"[{self.__class__.__name__}] rule not created by this tool left as it is: {line}")
+                continue
+            rules.append((line, rule))
+        return rules
+
+    def list_rules(self) -> list[FirewallRule]:
+        return [rule for _, rule in self._list_chain()]
+
+    def sync_rules(self, rules: Iterable[FirewallRule]) -> tuple[int, int]:
+        # rules that cannot be read are never deleted, and the others are deleted through their listed line, so a
+        # deletion always matches the rule in the chain
+        adds, deleted_lines = self._diff_rules(rules, [(rule, line) for line, rule in self._list_chain()])
+        if adds or deleted_lines:
+            script = self._write_restore_script(adds=adds, deletes=(), deleted_lines=deleted_lines)
+            self.command_executor.execute("iptables-restore --noflush", input=script)
+        return len(adds), len(deleted_lines)
+
+
+class NFTablesWriter(FirewallWriter):
+    """
+    Keeps the rules as elements of nftables verdict maps, keyed by the concatenation of protocol, destination port and
+    the four flow counters, with interval flags. Each packet is classified by a map lookup, whose cost does not grow
+    linearly with the number of rules like a chain of iptables entries does.
+
+    Elements of the same map must not overlap, so rules are spread over layers: a rule goes to the layer right after
+    the last one holding a rule it overlaps, and the chain looks the layers up in order. As in an iptables chain, the
+    rule written first wins where rules overlap, and disjoint rules, the common case once rules are compacted, all
+    share the first layer.
+
+    With render_only, nft scripts are not executed but kept in rendered_scripts, and the map contents are tracked in
+    memory, so the writer can be used without root or without nftables at all.
+    """
+
+    _family = 'inet'
+    _key = 'meta l4proto . th dport . ct bytes . ct packets . ct original packets . ct reply packets'
+    _reject_chain = 'reject_flow'
+    # bounds used for the dimensions a rule does not restrict
+    _protocol_range = (0, 255)
+    _port_range = (0, 65535)
+    _counter_range = (0, 2 ** 64 - 1)
+    _max_elements_per_statement = 1000
+
+    def __init__(self, command_executor: CommandExecutor | None, chain: str, table: str, hook: str = 'forward',
+                 render_only: bool = False):
+        if command_executor is None and not render_only:
+            raise ValueError("command executor required unless render_only is set")
+        self.command_executor = command_executor
+        self.chain = chain
+        self.table = table
+        self.hook = hook
+        self.render_only = render_only
+        self.rendered_scripts: list[str] = []
+        self._rendered_layers: list[dict[str, FirewallRule]] | None = None
+
+    def map_name(self, layer: int) -> str:
+        return f'{self.chain}_rules_{layer}'
+
+    @staticmethod
+    def _write_interval(lower: int, upper: int) -> str:
+        return str(lower) if lower == upper else f'{lower}-{upper}'
+
+    @classmethod
+    def _get_counter_bounds(cls, lower: float | None, upper: float | None) -> tuple[int, int]:
+        if lower is None or upper is None:
+            return cls._counter_range
+        # counters are integers: the interval is widened to the integers that contain it
+        return max(0, math.floor(lower)), max(0, math.ceil(upper))
+
+    @classmethod
+    def _write_counter(cls, lower: float | None, upper: float | None) -> str:
+        return cls._write_interval(*cls._get_counter_bounds(lower, upper))
+
+    @classmethod
+    def _write_nft_element(cls, rule: FirewallRule) -> str:
+        # check whether rule is valid
+        if not rule.protocol and rule.dst_port:
+            raise ValueError("port must specify a protocol")
+        protocol = rule.protocol.lower() if rule.protocol else cls._write_interval(*cls._protocol_range)
+        port = str(rule.dst_port) if rule.dst_port else cls._write_interval(*cls._port_range)
+        counters = [
+            cls._write_counter(rule.min_fl_byt_s, rule.max_fl_byt_s),
+            cls._write_counter(rule.min_fl_pkt_s, rule.max_fl_pkt_s),
+            cls._write_counter(rule.min_tot_fw_pk, rule.max_tot_fw_pk),
+            cls._write_counter(rule.min_tot_bw_pk, rule.max_tot_bw_pk),
+        ]
+        key = ' . '.join([protocol, port] + counters)
+        return f'{key} : {cls._write_verdict(rule.action)}'
+
+    @classmethod
+    def _get_element_boxes(cls, rules: list[FirewallRule]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Lower and upper bounds of the elements of the rules, one row per rule over protocol, port and the four
+        counters. Protocols are numbered by name, and unrestricted protocols and ports span every value.
+        """
+        protocols: dict[str, int] = {}
+        lower, upper = np.empty((len(rules), 6)), np.empty((len(rules), 6))
+        for i, rule in enumerate(rules):
+            protocol = protocols.setdefault(rule.protocol.lower(), len(protocols)) if rule.protocol else None
+            port = rule.dst_port or None
+            lower[i, :2] = [-np.inf if value is None else value for value in (protocol, port)]
+            upper[i, :2] = [np.inf if value is None else value for value in (protocol, port)]
+            lower[i, 2:], upper[i, 2:] = np.array([
+                cls._get_counter_bounds(rule.min_fl_byt_s, rule.max_fl_byt_s),
+                cls._get_counter_bounds(rule.min_fl_pkt_s, rule.max_fl_pkt_s),
+                cls._get_counter_bounds(rule.min_tot_fw_pk, rule.max_tot_fw_pk),
+                cls._get_counter_bounds(rule.min_tot_bw_pk, rule.max_tot_bw_pk),
+            ], dtype=float).T
+        return lower, upper
+
+    @classmethod
+    def _find_earlier_overlaps(cls, lower: np.ndarray, upper: np.ndarray, start: int) -> dict[int, np.ndarray]:
+        """
+        For every box from position start on, the positions of the boxes before it that it overlaps. Boxes are swept
+        by their lower bound in the counter that the fewest of them leave unrestricted, so that each box is only
+        compared with those that overlap it in that counter.
+        """
+        unrestricted = (lower[:, 2:] == cls._counter_range[0]) & (upper[:, 2:] == cls._counter_range[1])
+        dimension = 2 + int(np.argmin(unrestricted.sum(axis=0)))
+        overlaps: dict[int, list[np.ndarray]] = {}
+        active = np.empty(0, dtype=int)
+        for position in np.argsort(lower[:, dimension], kind='stable'):
+            active = active[upper[active, dimension] >= lower[position, dimension]]
+            touching = active[((lower[active] <= upper[position]) & (upper[active] >= lower[position])).all(axis=1)]
+            if position >= start:
+                overlaps.setdefault(position, []).append(touching[touching < position])
+            for other in touching[(touching > position) & (touching >= start)]:
+                overlaps.setdefault(int(other), []).append(np.array([position]))
+            active = np.append(active, position)
+        return {position: np.concatenate(found) for position, found in overlaps.items()}
+
+    @classmethod
+    def _place_rules(cls, layers: list[dict[str, FirewallRule]], rules: Iterable[FirewallRule]) \
+            -> list[tuple[int, FirewallRule]]:
+        """
+        Adds rules to the layers, each one to the layer right after the last one holding a rule it overlaps, and
+        returns the (layer, rule) pairs that were added. Rules already in a layer are left where they are and come
+        before the new ones.
+        """
+        existing = [(layer, rule) for layer, elements in enumerate(layers) for rule in elements.values()]
+        new: dict[str, FirewallRule] = {}
+        for rule in rules:
+            key = cls._write_nft_element(rule)
+            if key not in new and not any(key in elements for elements in layers):
+                new[key] = rule
+        if not new:
+            return []
+        lower, upper = cls._get_element_boxes([rule for _, rule in existing] + list(new.values()))
+        overlaps = cls._find_earlier_overlaps(lower, upper, start=len(existing))
+        element_layers = np.array([layer for layer, _ in existing] + [0] * len(new))
+        placed = []
+        for position, (key, rule) in enumerate(new.items(), start=len(existing)):
+            earlier = overlaps.get(position)
+            layer = int(element_layers[earlier].max()) + 1 if earlier is not None and len(earlier) else 0
+            element_layers[position] = layer
+            if layer == len(layers):
+                layers.append({})
+            layers[layer][key] = rule
+            placed.append((layer, rule))
+        return placed
+
+    @classmethod
+    def _write_verdict(cls, action: Action) -> str:
+        # reject is a statement, not a verdict, so blocked flows go through a chain that rejects them
+        if action == Action.BLOCK:
+            return f'goto {cls._reject_chain}'
+        return 'accept'
+
+    @classmethod
+    def _read_verdict(cls, verdict: str) -> Action:
+        if verdict == f'goto {cls._reject_chain}':
+            return Action.BLOCK
+        return Action.ALLOW
+
+    @staticmethod
+    def _is_full_range(value: str, full_range: tuple[int, int]) -> bool:
+        # the lower bound may be printed by name, e.g. hopopt-255
+        _, separator, upper = value.rpartition('-')
+        return bool(separator) and upper == str(full_range[1])
+
+    @classmethod
+    def _read_counter(cls, value: str, cast: type) -> tuple:
+        lower, _, upper = value.partition('-')
+        bounds = int(lower), int(upper or lower)
+        if bounds == cls._counter_range:
+            return None, None
+        return cast(bounds[0]), cast(bounds[1])
+
+    @classmethod
+    def _read_nft_elements(cls, map_str: str) -> list[FirewallRule]:
+        start = map_str.find('elements = {')
+        if start == -1:
+            return []
+        body = map_str[start + len('elements = {'):map_str.index('}', start)]
+        rules = []
+        for element in body.split(','):
+            if not element.strip():
+                continue
+            key, _, verdict = element.partition(':')
+            protocol, port, *counters = [token.strip() for token in key.split('.')]
+            fields = {
+                # unrestricted protocols and ports are printed as the interval that covers every value
+                'protocol': None if cls._is_full_range(protocol, cls._protocol_range) else protocol,
+                'dst_port': None if cls._is_full_range(port, cls._port_range) else IPTablesWriter._translate_port(port),
+                'action': cls._read_verdict(verdict.strip()),
+            }
+            fields['min_fl_byt_s'], fields['max_fl_byt_s'] = cls._read_counter(counters[0], float)
+            fields['min_fl_pkt_s'], fields['max_fl_pkt_s'] = cls._read_counter(counters[1], float)
+            fields['min_tot_fw_pk'], fields['max_tot_fw_pk'] = cls._read_counter(counters[2], int)
+            fields['min_tot_bw_pk'], fields['max_tot_bw_pk'] = cls._read_counter(counters[3], int)
+            rules.append(FirewallRule(**fields))
+        return rules
+
+    def _read_nft_layers(self, table_str: str) -> list[dict[str, FirewallRule]]:
+        """
+        Elements of every layer map in the output of `nft list table`, by layer. Layers left empty are kept, since
+        their maps and lookups still exist.
+        """
+        starts = [(match.start(), match.group(1)) for match in re.finditer(r'^\s*(?:map|chain) (\S+) \{', table_str,
+                                                                            flags=re.MULTILINE)]
+        layers: dict[int, dict[str, FirewallRule]] = {}
+        for (start, name), (end, _) in zip(starts, starts[1:] + [(len(table_str), None)]):
+            match = re.fullmatch(rf'{re.escape(self.chain)}_rules_(\d+)', name)
+            if match is None or not table_str[start:end].lstrip().startswith('map'):
+                continue
+            layers[int(match.group(1))] = {
+                self.rule_key(rule): rule for rule in self._read_nft_elements(table_str[start:end])}
+        return [layers.get(layer, {}) for layer in range(max(layers, default=-1) + 1)]
+
+    def _write_element_statements(self, operation: str, layer: int, rules: Iterable[FirewallRule]) -> list[str]:
+        elements = [self._write_nft_element(rule) for rule in rules]
+        if operation == 'delete':
+            # elements are deleted by their key alone
+            elements = [element.rpartition(' : ')[0] for element in elements]
+        return [f"{operation} element {self._family} {self.table} {self.map_name(layer)} "
+                f"{{ {', '.join(elements[start:start + self._max_elements_per_statement])} }}"
+                for start in range(0, len(elements), self._max_elements_per_statement)]
+
+    def _write_layer_statements(self, layer: int) -> list[str]:
+        # lookups are appended to the chain, so layers must be created in order
+        return [
+            f"add map {self._family} {self.table} {self.map_name(layer)} "
+            f"{{ typeof {self._key} : verdict; flags interval; }}",
+            f"add rule {self._family} {self.table} {self.chain} {self._key} vmap @{self.map_name(layer)}",
+        ]
+
+    def _write_placed_statements(self, placed: list[tuple[int, FirewallRule]]) -> list[str]:
+        by_layer: dict[int, list[FirewallRule]] = {}
+        for layer, rule in placed:
+            by_layer.setdefault(layer, []).append(rule)
+        lines = []
+        for layer in sorted(by_layer):
+            lines += self._write_element_statements('add', layer, by_layer[layer])
+        return lines
+
+    def render_ruleset(self, rules: Iterable[FirewallRule] = ()) -> str:
+        """
+        Script that replaces the whole table with one holding the given rules.
+        """
+        layers: list[dict[str, FirewallRule]] = [{}]
+        placed = self._place_rules(layers, rules)
+        lines = [
+            # declaring the table first lets it be deleted whether it already exists or not
+            f"table {self._family} {self.table} {{}}",
+            f"delete table {self._family} {self.table}",
+            f"table {self._family} {self.table} {{",
+            f"    chain {self._reject_chain} {{",
+            f"        reject",
+            f"    }}",
+            f"    chain {self.chain} {{",
+            f"        type filter hook {self.hook} priority filter; policy accept;",
+            f"    }}",
+            f"}}",
+        ]
+        for layer in range(len(layers)):
+            lines += self._write_layer_statements(layer)
+        lines += self._write_placed_statements(placed)
+        return "\n".join(lines) + "\n"
+
+    def render_batch(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = (),
+                     layers: list[dict[str, FirewallRule]] | None = None) -> str:
+        """
+        Script that applies the changes to the layers currently in the table, or to the given ones. The layers are
+        updated in place with the changes.
+        """
+        layers = layers if layers is not None else self._get_layers()
+        lines = []
+        deleted: dict[int, list[FirewallRule]] = {}
+        for rule in deletes:
+            key = self.rule_key(rule)
+            layer = next((layer for layer, elements in enumerate(layers) if key in elements), None)
+            if layer is None:
+                raise RuntimeError(f"Element not found in the maps of chain {self.chain}: {key}")
+            deleted.setdefault(layer, []).append(layers[layer].pop(key))
+        for layer in sorted(deleted):
+            lines += self._write_element_statements('delete', layer, deleted[layer])
+        existing_layers = len(layers)
+        placed = self._place_rules(layers, adds)
+        for layer in range(existing_layers, len(layers)):
+            lines += self._write_layer_statements(layer)
+        lines += self._write_placed_statements(placed)
+        return "\n".join(lines) + "\n"
+
+    def _execute_script(self, script: str):
+        # nft -f applies the whole script as a single transaction
+        if self.render_only:
+            self.rendered_scripts.append(script)
+            return
+        self.command_executor.execute("nft -f -", input=script)
+
+    async def _execute_script_async(self, script: str):
+        if self.render_only:
+            self.rendered_scripts.append(script)
+            return
+        await self.command_executor.execute_async("nft -f -", input=script)
+
+    def _get_layers(self) -> list[dict[str, FirewallRule]]:
+        if self.render_only:
+            if self._rendered_layers is None:
+                raise RuntimeError(f"Table {self.table} has not been loaded")
+            return [dict(elements) for elements in self._rendered_layers]
+        return self._read_nft_layers(self.command_executor.execute(f"nft list table {self._family} {self.table}"))
+
+    def load_ruleset(self, rules: Iterable[FirewallRule] = ()):
+        rules = list(rules)
+        self._execute_script(self.render_ruleset(rules))
+        if self.render_only:
+            self._rendered_layers = [{}]
+            self._place_rules(self._rendered_layers, rules)
+
+    def table_exists(self) -> bool:
+        if self.render_only:
+            return self._rendered_layers is not None
+        try:
+            self.command_executor.execute(f"nft list table {self._family} {self.table}")
+        except RuntimeError as e:
+            if 'No such file or directory' in str(e):
+                return False
+            raise
+        return True
+
+    def append_rule(self, rule: FirewallRule):
+        self.apply_batch(adds=[rule])
+
+    def prepend_rule(self, rule: FirewallRule):
+        # layers are only ever appended, so a rule overlapping existing ones is matched after them
+        self.apply_batch(adds=[rule])
+
+    def delete_rule(self, rule: FirewallRule):
+        self.apply_batch(deletes=[rule])
+
+    def apply_batch(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        layers = self._get_layers()
+        self._execute_script(self.render_batch(adds=adds, deletes=deletes, layers=layers))
+        if self.render_only:
+            self._rendered_layers = layers
+
+    async def apply_batch_async(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        adds, deletes = list(adds), list(deletes)
+        layers = await asyncio.to_thread(self._get_layers)
+        await self._execute_script_async(self.render_batch(adds=adds, deletes=deletes, layers=layers))
+        if self.render_only:
+            self._rendered_layers = layers
+
+    def rule_key(self, rule: FirewallRule) -> str:
+        return self._write_nft_element(rule)
+
+    def flush(self):
+        # an empty ruleset drops the layers along with their elements
+        self.load_ruleset([])
+
+    def list_rules(self) -> list[FirewallRule]:
+        if self.render_only and self._rendered_layers is None:
+            return []
+        # rules are listed in priority order
+        return [rule for elements in self._get_layers() for rule in elements.values()]
+
+    def sync_rules(self, rules: Iterable[FirewallRule]) -> tuple[int, int]:
+        # the table, maps and chains are created by the first synchronization
+        if not self.table_exists():
+            rules = list(rules)
+            self.load_ruleset(rules)
+            return len(rules), 0
+        return super().sync_rules(rules)
+
+
+class FirewallWriterGroup(FirewallWriter):
+    """
+    Applies every change to several firewall hosts concurrently, so pushing a change takes about as long as the slowest
+    host. Each host gets timeout_seconds to finish an operation. A host that fails or times out does not stop the
+    others: once every host has finished or timed out, operations raise FirewallHostsFailedException with the result
+    of each host, so the caller can retry or alert, and the *_per_host methods return those results instead.
+
+    Hosts are driven from a thread pool of the group, so the sync methods do not depend on an event loop and the async
+    ones can be awaited from a running one. A timed out host keeps its worker until its own command returns, which its
+    executor bounds, but nothing waits for it.
+    """
+
+    def __init__(self, writers: dict[str, FirewallWriter], timeout_seconds: float | None = None):
+        if not writers:
+            raise ValueError("at least one firewall writer is required")
+        self.writers = writers
+        self.timeout_seconds = timeout_seconds
+        # room for a second operation on every host while the previous one of a hung host is still running
+        self._pool = ThreadPoolExecutor(max_workers=2 * len(writers), thread_name_prefix='firewall-host')
+
+    def _check_results(self, results: dict[str, T | BaseException], raise_on_failure: bool) \
+            -> dict[str, T | BaseException]:
+        for host, result in results.items():
+            if isinstance(result, BaseException):
+                logging.error(f"[{self.__class__.__name__}] firewall host {host} failed: {result!r}")
+        if raise_on_failure and any(isinstance(result, BaseException) for result in results.values()):
+            raise FirewallHostsFailedException(results)
+        return results
+
+    def _run(self, operation: Callable[[FirewallWriter], T], raise_on_failure: bool = True) \
+            -> dict[str, T | BaseException]:
+        futures = {host: self._pool.submit(operation, writer) for host, writer in self.writers.items()}
+        wait(futures.values(), timeout=self.timeout_seconds)
+        results = {}
+        for host, future in futures.items():
+            if not future.done():
+                future.cancel()
+                results[host] = TimeoutError(f"host did not finish within {self.timeout_seconds}s")
+            elif future.exception() is not None:
+                results[host] = future.exception()
+            else:
+                results[host] = future.result()
+        return self._check_results(results, raise_on_failure)
+
+    async def _gather(self, operation: Callable[[FirewallWriter], T], raise_on_failure: bool = True) \
+            -> dict[str, T | BaseException]:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(asyncio.wait_for(loop.run_in_executor(self._pool, operation, writer), timeout=self.timeout_seconds)
+              for writer in self.writers.values()),
+            return_exceptions=True)
+        return self._check_results(dict(zip(self.writers.keys(), results)), raise_on_failure)
+
+    def append_rule(self, rule: FirewallRule):
+        self._run(lambda writer: writer.append_rule(rule))
+
+    def prepend_rule(self, rule: FirewallRule):
+        self._run(lambda writer: writer.prepend_rule(rule))
+
+    def delete_rule(self, rule: FirewallRule):
+        self._run(lambda writer: writer.delete_rule(rule))
+
+    def apply_batch(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        adds, deletes = list(adds), list(deletes)
+        self._run(lambda writer: writer.apply_batch(adds, deletes))
+
+    def apply_batch_per_host(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()) \
+            -> dict[str, None | BaseException]:
+        adds, deletes = list(adds), list(deletes)
+        return self._run(lambda writer: writer.apply_batch(adds, deletes), raise_on_failure=False)
+
+    async def apply_batch_async(self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()):
+        adds, deletes = list(adds), list(deletes)
+        await self._gather(lambda writer: writer.apply_batch(adds, deletes))
+
+    async def apply_batch_async_per_host(
+            self, adds: Iterable[FirewallRule] = (), deletes: Iterable[FirewallRule] = ()) \
+            -> dict[str, None | BaseException]:
+        adds, deletes = list(adds), list(deletes)
+        return await self._gather(lambda writer: writer.apply_batch(adds, deletes), raise_on_failure=False)
+
+    def flush(self):
+        self._run(lambda writer: writer.flush())
+
+    def list_rules(self) -> list[FirewallRule]:
+        # hosts are kept in sync, so the rules of the first one stand for the whole group
+        return next(iter(self.writers.values())).list_rules()
+
+    def list_rules_per_host(self) -> dict[str, list[FirewallRule] | BaseException]:
+        return self._run(lambda writer: writer.list_rules(), raise_on_failure=False)
+
+    async def list_rules_async_per_host(self) -> dict[str, list[FirewallRule] | BaseException]:
+        return await self._gather(lambda writer: writer.list_rules(), raise_on_failure=False)
+
+    def rule_key(self, rule: FirewallRule) -> str:
+        return next(iter(self.writers.values())).rule_key(rule)
+
+    def sync_rules(self, rules: Iterable[FirewallRule]) -> tuple[int, int]:
+        # every host is diffed against its own chain, since hosts may have drifted apart
+        rules = list(rules)
+        results = self._run(lambda writer: writer.sync_rules(rules))
+        return sum(adds for adds, _ in results.values()), sum(deletes for _, deletes in results.values())
+
+    def sync_rules_per_host(self, rules: Iterable[FirewallRule]) -> dict[str, tuple[int, int] | BaseException]:
+        rules = list(rules)
+        return self._run(lambda writer: writer.sync_rules(rules), raise_on_failure=False)
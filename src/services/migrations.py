@@ -0,0 +1,86 @@
+import logging
+
+from sqlalchemy import Engine, Table, bindparam, delete, inspect, select, text, update
+
+from src.models.critical_rule import CriticalRule
+from src.models.fingerprint import RULE_CONTENT_FIELDS, rule_fingerprint
+from src.models.firewall_rule import FirewallRule
+from src.services.database import DBSessionManager
+
+_batch_size = 10_000
+
+
+def _add_fingerprint_column(engine: Engine, table: Table):
+    column = table.c.fingerprint
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                                f'{column.type.compile(engine.dialect)}'))
+    logging.info(f"[migrations] column {table.name}.{column.name} added")
+
+
+def _backfill_fingerprints(engine: Engine, table: Table) -> int:
+    # rows are read in batches of ids, so the table is never held in memory at once
+    columns = [table.c.id, *(table.c[field] for field in RULE_CONTENT_FIELDS)]
+    statement = update(table).where(table.c.id == bindparam('row_id')).values(fingerprint=bindparam('row_fingerprint'))
+    last_id, filled = None, 0
+    while True:
+        query = select(*columns).where(table.c.fingerprint.is_(None)).order_by(table.c.id).limit(_batch_size)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        with engine.begin() as connection:
+            rows = connection.execute(query).mappings().all()
+            if not rows:
+                return filled
+            connection.execute(statement, [{'row_id': row['id'], 'row_fingerprint': rule_fingerprint(row)}
+                                           for row in rows])
+        last_id, filled = rows[-1]['id'], filled + len(rows)
+
+
+def _delete_repeated_rules(engine: Engine, table: Table) -> int:
+    # the oldest copy of each rule is kept, as bulk_insert would have done had the fingerprint existed
+    seen, repeated_ids = set(), []
+    with engine.begin() as connection:
+        for row_id, fingerprint in connection.execute(select(table.c.id, table.c.fingerprint).order_by(table.c.id)):
+            if fingerprint in seen:
+                repeated_ids.append(row_id)
+            seen.add(fingerprint)
+        for start in range(0, len(repeated_ids), _batch_size):
+            connection.execute(delete(table).where(table.c.id.in_(repeated_ids[start:start + _batch_size])))
+    return len(repeated_ids)
+
+
+def migrate_rule_fingerprints(engine: Engine):
+    """
+    One-off migration of databases created before rules had fingerprints, since create_all does not alter existing
+    tables. Adds the fingerprint column, fills it for every row through rule_fingerprint and creates the missing
+    indexes of both rule tables. Firewall rules must be unique by fingerprint, so repeated copies of a rule are deleted
+    before its unique index is created. Running it again only fills what is still missing.
+    """
+    for model in (FirewallRule, CriticalRule):
+        table: Table = model.__table__
+        inspector = inspect(engine)
+        if not inspector.has_table(table.name):
+            # created whole by create_all
+            continue
+        if 'fingerprint' not in {column['name'] for column in inspector.get_columns(table.name)}:
+            _add_fingerprint_column(engine, table)
+        logging.info(f"[migrations] {_backfill_fingerprints(engine, table)} fingerprints filled in {table.name}")
+        if table.c.fingerprint.unique:
+            logging.info(f"[migrations] {_delete_repeated_rules(engine, table)} repeated rules deleted from "
+                         f"{table.name}")
+        existing_indexes = {index['name']: bool(index['unique']) for index in inspect(engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes and existing_indexes[index.name] == index.unique:
+                continue
+            with engine.begin() as connection:
+                if index.name in existing_indexes:
+                    # created by hand without the uniqueness the model declares
+                    index.drop(connection)
+                index.create(connection)
+            logging.info(f"[migrations] index {index.name} created on {table.name}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with DBSessionManager().get_session() as session:
+        migrate_rule_fingerprints(session.get_bind())
@@ -0,0 +1,49 @@
+import tempfile
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel
+
+from src.api.api import api
+from src.common.config import ConfigurationManager
+from src.models.user import User
+from src.services.auth import TokenAuthManager
+from src.services.database import DBSessionManager
+
+
+if __name__ == '__main__':
+    # the configured database, replaced by a sqlite file so that pool checkouts can be counted
+    db_config = ConfigurationManager().get_database_config()
+    db_config.dbms, db_config.name = 'sqlite', str(Path(tempfile.mkdtemp()) / 'auth_cache.db')
+    db_manager = DBSessionManager()
+    db_manager.load()
+    SQLModel.metadata.create_all(db_manager._engine)
+    with db_manager.get_session() as session:
+        user = User.mock().save(session)
+        token = TokenAuthManager().generate_token(user, session, ConfigurationManager().get_auth_config().token)
+
+    opened_sessions = []
+    get_session = db_manager.get_session
+    db_manager.get_session = lambda: opened_sessions.append(1) or get_session()
+    client = TestClient(api)
+    headers = {'Authorization': f'Bearer {token}'}
+
+    # the first request misses the cache and loads the user from the database
+    response = client.get('/users/me', headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()['username'] == user.username
+    assert len(opened_sessions) == 1, opened_sessions
+
+    # a cached token is authenticated without opening a session or checking a connection out of the pool
+    checkouts = db_manager.get_pool_metrics().total_checkouts
+    for _ in range(5):
+        assert client.get('/users/me', headers=headers).json()['username'] == user.username
+    assert len(opened_sessions) == 1, opened_sessions
+    assert db_manager.get_pool_metrics().total_checkouts == checkouts
+
+    # once the user changes, the token is authenticated against the database again
+    TokenAuthManager().invalidate_user(user.id)
+    assert client.get('/users/me', headers=headers).status_code == 200
+    assert len(opened_sessions) == 2, opened_sessions
+    assert client.get('/users/me', headers={'Authorization': 'Bearer invalid'}).status_code == 401
+    print('ok')
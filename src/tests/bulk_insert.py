@@ -0,0 +1,37 @@
+import tempfile
+from pathlib import Path
+
+from sqlmodel import SQLModel, Session, create_engine, select, func
+
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+
+
+def create_rules(ports: list[int]) -> list[FirewallRule]:
+    return [FirewallRule(protocol='tcp', dst_port=port, action=Action.BLOCK, min_tot_fw_pk=1, max_tot_fw_pk=5)
+            for port in ports]
+
+
+def check_bulk_insert(engine):
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        first_ids = FirewallRule.bulk_insert(session, create_rules([80, 443]))
+        assert len(first_ids) == 2, first_ids
+        # existing rules, and repetitions within the same call, are skipped rather than failing the insert
+        ids = FirewallRule.bulk_insert(session, create_rules([80, 22, 22, 8080]))
+        assert len(ids) == 2 and not set(ids) & set(first_ids), ids
+        saved = FirewallRule.get_by_ids(session, ids)
+        assert sorted(rule.dst_port for rule in saved) == [22, 8080], saved
+        assert session.scalar(select(func.count()).select_from(FirewallRule)) == 4
+
+
+if __name__ == '__main__':
+    directory = Path(tempfile.mkdtemp())
+    # conflicts skipped by the database
+    check_bulk_insert(create_engine(f'sqlite:///{directory / "native.db"}'))
+    # a database without ON CONFLICT nor executemany with RETURNING: conflicts are filtered out beforehand and rows
+    # are inserted one at a time
+    engine = create_engine(f'sqlite:///{directory / "fallback.db"}')
+    engine.dialect.name, engine.dialect.insert_executemany_returning = 'unsupported', False
+    check_bulk_insert(engine)
+    print('ok')
@@ -0,0 +1,51 @@
+import asyncio
+import tempfile
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from sqlalchemy import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.api.api import api
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+from src.services.auth import get_current_user
+from src.services.database import get_async_session
+
+
+if __name__ == '__main__':
+    # a file database without pooling, since the rules are created in another event loop than the requests run in
+    engine = create_async_engine(f'sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / "filters.db"}', poolclass=NullPool)
+
+    async def create_rules():
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            session.add_all([FirewallRule(protocol='tcp', dst_port=80, action=Action.BLOCK, min_tot_fw_pk=1,
+                                          max_tot_fw_pk=5),
+                             FirewallRule(protocol='tcp', dst_port=443, action=Action.ALLOW)])
+            await session.commit()
+
+    async def get_test_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    asyncio.run(create_rules())
+    api.dependency_overrides[get_async_session] = get_test_session
+    api.dependency_overrides[get_current_user] = lambda: True
+    client = TestClient(api)
+
+    # a projected list holds the id and the requested fields only, nothing filled in with defaults
+    for query in ['fields=action,dstPort', 'fields=action&fields=dstPort', 'fields=action,dst_port']:
+        response = client.get(f'/firewall-rules/?protocol=tcp&{query}')
+        assert response.status_code == 200, response.text
+        rows = response.json()['data']
+        assert [set(row) for row in rows] == [{'id', 'action', 'dstPort'}] * 2, rows
+        assert rows[0] == {'id': 1, 'action': 'block', 'dstPort': 80}, rows
+    # without fields, every column is returned as stored
+    rows = client.get('/firewall-rules/?protocol=tcp').json()['data']
+    assert rows[0]['maxTotFwPk'] == 5 and rows[0]['createdAt'] is not None, rows
+    assert client.get('/firewall-rules/?protocol=tcp&fields=unknown').status_code == 400
+    print('ok')
@@ -0,0 +1,103 @@
+import asyncio
+from time import monotonic, sleep
+
+from src.common.exceptions.firewall import FirewallHostsFailedException
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+from src.services.executor import CommandExecutor
+from src.services.firewall import FirewallWriterGroup, IPTablesWriter
+from src.tests.iptables import FakeIPTables
+
+
+class StubExecutor(CommandExecutor):
+    """
+    Host that takes delay_seconds to run every command, and then fails it when failing is set.
+    """
+
+    def __init__(self, delay_seconds: float = 0, failing: bool = False):
+        self.delay_seconds = delay_seconds
+        self.failing = failing
+
+    def execute(self, command, input=None):
+        sleep(self.delay_seconds)
+        if self.failing:
+            raise RuntimeError(f'host unreachable: {command}')
+        return '-N TEST\n'
+
+
+def build_group(timeout_seconds: float | None = 0.5) -> tuple[FirewallWriterGroup, FakeIPTables]:
+    healthy = FakeIPTables([])
+    writers = {
+        'healthy': IPTablesWriter(healthy, chain='TEST', table='filter'),
+        'hung': IPTablesWriter(StubExecutor(delay_seconds=2), chain='TEST', table='filter'),
+        'broken': IPTablesWriter(StubExecutor(failing=True), chain='TEST', table='filter'),
+    }
+    return FirewallWriterGroup(writers, timeout_seconds=timeout_seconds), healthy
+
+
+def check_results(results: dict):
+    assert list(results) == ['healthy', 'hung', 'broken'], results
+    assert isinstance(results['hung'], TimeoutError), results
+    assert isinstance(results['broken'], RuntimeError), results
+
+
+if __name__ == '__main__':
+    rules = [FirewallRule(protocol='tcp', dst_port=80, action=Action.BLOCK)]
+
+    # a failing or hung host does not stop the others, and the operation reports every host once all are done
+    group, healthy = build_group()
+    start = monotonic()
+    try:
+        group.apply_batch(adds=rules)
+        raise AssertionError('failed hosts were not reported')
+    except FirewallHostsFailedException as e:
+        assert e.failed_hosts == ['hung', 'broken'], e.failed_hosts
+        assert e.results['healthy'] is None
+        check_results(e.results)
+    # the hung host is given up on at host_timeout_seconds instead of being waited for
+    assert monotonic() - start < 1.5
+    assert healthy.lines == ['-A TEST -p tcp --dport 80 -j REJECT'], healthy.lines
+
+    # the *_per_host methods return the result of every host instead of raising
+    group, healthy = build_group()
+    results = group.sync_rules_per_host(rules)
+    check_results(results)
+    assert results['healthy'] == (1, 0), results
+    results = group.list_rules_per_host()
+    check_results(results)
+    assert [rule.dst_port for rule in results['healthy']] == [80], results
+    results = group.apply_batch_per_host(deletes=rules)
+    check_results(results)
+    assert healthy.lines == [], healthy.lines
+    try:
+        group.sync_rules(rules)
+        raise AssertionError('failed hosts were not reported')
+    except FirewallHostsFailedException as e:
+        assert e.failed_hosts == ['hung', 'broken'], e.failed_hosts
+
+    # the async methods behave alike, and can be awaited from a running event loop
+    async def check_async():
+        group, healthy = build_group()
+        results = await group.apply_batch_async_per_host(adds=rules)
+        check_results(results)
+        assert healthy.lines == ['-A TEST -p tcp --dport 80 -j REJECT'], healthy.lines
+        results = await group.list_rules_async_per_host()
+        check_results(results)
+        try:
+            await group.apply_batch_async(deletes=rules)
+            raise AssertionError('failed hosts were not reported')
+        except FirewallHostsFailedException as e:
+            check_results(e.results)
+        assert healthy.lines == [], healthy.lines
+
+    start = monotonic()
+    asyncio.run(check_async())
+    assert monotonic() - start < 2.5
+
+    # without a timeout, slow hosts are waited for
+    group = FirewallWriterGroup({'slow': IPTablesWriter(StubExecutor(delay_seconds=0.6), chain='TEST', table='filter'),
+                                 'fast': IPTablesWriter(FakeIPTables([]), chain='TEST', table='filter')},
+                                timeout_seconds=None)
+    assert group.list_rules_per_host() == {'slow': [], 'fast': []}
+    assert group.sync_rules(rules) == (2, 0)
+    print('ok')
@@ -0,0 +1,104 @@
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+from src.services.executor import CommandExecutor
+from src.services.firewall import IPTablesWriter
+
+
+class FakeIPTables(CommandExecutor):
+    """
+    Chain held in memory, listed by -S as the lines it holds. iptables-restore applies a script as one transaction,
+    and a deletion has to match a line of the chain exactly.
+    """
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self.scripts: list[str] = []
+
+    def execute(self, command, input=None):
+        if command.startswith('iptables-restore'):
+            self.scripts.append(input)
+            lines = list(self.lines)
+            for statement in input.splitlines()[1:-1]:
+                operation, _, spec = statement.partition(' ')
+                if operation == '-A':
+                    lines.append(f'-A {spec}')
+                elif f'-A {spec}' in lines:
+                    lines.remove(f'-A {spec}')
+                else:
+                    raise RuntimeError(f'iptables-restore: line failed: {statement}')
+            self.lines = lines
+            return ''
+        assert ' -S ' in command, command
+        return '\n'.join(['-N TEST', *self.lines]) + '\n'
+
+
+if __name__ == '__main__':
+    # the tokenizer splits a -S line into its chain, match blocks, target and target options
+    chain, blocks, target, target_options = IPTablesWriter._tokenize_iptables_rule(
+        '-A TEST -p tcp -m tcp ! --dport 22 -m comment --comment "two words" -j REJECT --reject-with tcp-reset')
+    assert chain == 'TEST' and target == 'REJECT', (chain, target)
+    assert blocks == [('', {'-p': 'tcp'}), ('tcp', {'! --dport': '22'}), ('comment', {'--comment': 'two words'})], \
+        blocks
+    assert target_options == {'--reject-with': 'tcp-reset'}, target_options
+    assert IPTablesWriter._tokenize_iptables_rule('-A TEST ! -s 10.0.0.1/32 -j DROP')[1] == \
+        [('', {'! -s': '10.0.0.1/32'})]
+
+    # rules written by the writer are read back as the same rules, from the way -S prints them
+    rule = FirewallRule(protocol='tcp', dst_port=80, min_fl_byt_s=100.0, max_fl_byt_s=200.0, min_tot_fw_pk=1,
+                        max_tot_fw_pk=5, action=Action.BLOCK)
+    listing = '\n'.join([
+        '-N TEST',
+        '-A TEST -p tcp -m tcp --dport 80 -m connbytes --connbytes 100:200 --connbytes-mode bytes '
+        '--connbytes-dir both -m conntrack --ctdir ORIGINAL --ctbytes 1:5 -j REJECT '
+        '--reject-with icmp-port-unreachable',
+        '-A TEST -p udp -m udp --dport domain -j ACCEPT',
+        '-A OTHER -p tcp -m tcp --dport 80 -j ACCEPT',
+    ])
+    rules = IPTablesWriter._read_iptables_rule(listing, chain='TEST')
+    assert [line.split()[1] for line, _ in rules] == ['TEST', 'TEST'], rules
+    assert IPTablesWriter._write_iptables_rule(rules[0][1]) == IPTablesWriter._write_iptables_rule(rule), rules[0]
+    assert (rules[1][1].protocol, rules[1][1].dst_port, rules[1][1].action) == ('udp', 53, Action.ALLOW), rules[1]
+
+    # anything a FirewallRule cannot express makes the rule unreadable rather than a different rule
+    for line in ['-A TEST -s 10.0.0.1/32 -j DROP',
+                 '-A TEST -s 10.0.0.1/32 -p tcp -m tcp --dport 80 -j REJECT --reject-with icmp-port-unreachable',
+                 '-A TEST -p tcp -m tcp ! --dport 22 -j REJECT --reject-with icmp-port-unreachable',
+                 '-A TEST ! -p tcp -j ACCEPT',
+                 '-A TEST -p tcp -m tcp --dport 22 -j REJECT --reject-with tcp-reset',
+                 '-A TEST -p tcp -m tcp --dport 1000:2000 -j ACCEPT',
+                 '-A TEST -i eth0 -j ACCEPT',
+                 '-A TEST -m connbytes --connbytes 100: --connbytes-mode bytes --connbytes-dir both -j ACCEPT',
+                 '-A TEST -m connbytes --connbytes 100:200 --connbytes-mode bytes --connbytes-dir original -j ACCEPT',
+                 '-A TEST -p tcp -m tcp --dport 80 -m conntrack --ctstate NEW -j ACCEPT',
+                 '-A TEST -p tcp -m tcp --dport 80 -j LOG',
+                 '-A TEST -p tcp -m tcp --dport 80']:
+        assert IPTablesWriter._read_iptables_rule(line) == [(line, None)], line
+
+    # the reconciler deletes rules through their listed line and leaves the rules it cannot read alone
+    foreign = '-A TEST -s 10.0.0.1/32 -p tcp -m tcp --dport 80 -j REJECT --reject-with icmp-port-unreachable'
+    stale = '-A TEST -p tcp -m tcp --dport 8080 -j REJECT --reject-with icmp-port-unreachable'
+    kept = '-A TEST -p tcp -m tcp --dport 80 -j REJECT --reject-with icmp-port-unreachable'
+    executor = FakeIPTables([foreign, '-A TEST -j DROP', stale, kept, kept])
+    writer = IPTablesWriter(executor, chain='TEST', table='filter')
+    wanted = [FirewallRule(protocol='tcp', dst_port=80, action=Action.BLOCK),
+              FirewallRule(protocol='tcp', dst_port=443, action=Action.ALLOW)]
+    assert writer.sync_rules(wanted) == (1, 2)
+    assert executor.lines == [foreign, '-A TEST -j DROP', kept, '-A TEST -p tcp --dport 443 -j ACCEPT'], \
+        executor.lines
+    assert f"-D {stale.removeprefix('-A ')}" in executor.scripts[0], executor.scripts[0]
+    assert writer.sync_rules(wanted) == (0, 0) and len(executor.scripts) == 1
+    assert len(writer.list_rules()) == 2
+
+    # a batch is one iptables-restore transaction: when one of its statements fails, none of them is applied
+    before = list(executor.lines)
+    try:
+        writer.apply_batch(adds=[FirewallRule(protocol='udp', dst_port=53, action=Action.ALLOW)],
+                           deletes=[FirewallRule(protocol='tcp', dst_port=443, action=Action.ALLOW),
+                                    FirewallRule(protocol='tcp', dst_port=9999, action=Action.BLOCK)])
+        raise AssertionError('a failed batch was not reported')
+    except RuntimeError:
+        pass
+    assert executor.lines == before, executor.lines
+    script = executor.scripts[-1].splitlines()
+    assert script[0] == '*filter' and script[-1] == 'COMMIT' and len(script) == 5, script
+    print('ok')
@@ -0,0 +1,51 @@
+import logging
+import tempfile
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect, text
+from sqlmodel import SQLModel, Session, select
+
+from src.models.critical_rule import CriticalRule
+from src.models.enums import Action
+from src.models.fingerprint import rule_content, rule_fingerprint
+from src.models.firewall_rule import FirewallRule
+from src.services.migrations import migrate_rule_fingerprints
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(f'sqlite:///{Path(tempfile.mkdtemp()) / "migrations.db"}')
+    # tables as created before rules had fingerprints, with none of the new indexes. The fingerprint column of
+    # firewall rules was added by hand, with an index lacking the uniqueness the model declares
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in ('firewallrule', 'criticalrule'):
+            for index in inspect(engine).get_indexes(table):
+                connection.execute(text(f'DROP INDEX {index["name"]}'))
+        connection.execute(text('ALTER TABLE criticalrule DROP COLUMN fingerprint'))
+        connection.execute(text('CREATE INDEX ix_firewallrule_fingerprint ON firewallrule (fingerprint)'))
+        for port, action in [(80, 'BLOCK'), (443, 'ALLOW'), (80, 'BLOCK'), (22, 'BLOCK')]:
+            connection.execute(text(f"INSERT INTO firewallrule (protocol, dst_port, action, created_at, updated_at) "
+                                    f"VALUES ('TCP', {port}, '{action}', '2024-01-01', '2024-01-01')"))
+            connection.execute(text(f"INSERT INTO criticalrule (title, protocol, dst_port, action, created_at, "
+                                    f"updated_at) VALUES ('t', 'tcp', {port}, '{action}', '2024-01-01', '2024-01-01')"))
+
+    migrate_rule_fingerprints(engine)
+    # running it again finds nothing left to do
+    migrate_rule_fingerprints(engine)
+
+    for model, n_rules in ((FirewallRule, 3), (CriticalRule, 4)):
+        indexes = {index['name']: bool(index['unique']) for index in inspect(engine).get_indexes(model.__tablename__)}
+        assert indexes == {index.name: bool(index.unique) for index in model.__table__.indexes}, indexes
+        with Session(engine) as session:
+            rules = session.exec(select(model).order_by(model.id)).all()
+            assert len(rules) == n_rules, rules
+            assert all(rule.fingerprint == rule_fingerprint(rule_content(rule)) for rule in rules), rules
+    # the oldest copy of the repeated firewall rule was kept
+    with Session(engine) as session:
+        assert [rule.id for rule in session.exec(select(FirewallRule).order_by(FirewallRule.id))] == [1, 2, 4]
+        # rules stored before the migration are now skipped by bulk_insert
+        assert FirewallRule.bulk_insert(session, [FirewallRule(protocol='tcp', dst_port=80, action=Action.BLOCK),
+                                                  FirewallRule(protocol='tcp', dst_port=8080, action=Action.BLOCK)]) \
+            == [5]
+    print('ok')
@@ -0,0 +1,56 @@
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+from src.services.firewall import NFTablesWriter
+
+
+if __name__ == '__main__':
+    # render_only does not need root, nor nftables installed
+    fw_writer = NFTablesWriter(command_executor=None, chain="TEST", table="fw_ips", render_only=True)
+    fw1 = FirewallRule(protocol="TCP", dst_port=80, min_fl_byt_s=950.2, max_fl_byt_s=1050.7, min_fl_pkt_s=9.5,
+                       max_fl_pkt_s=10.5, min_tot_fw_pk=4, max_tot_fw_pk=6, min_tot_bw_pk=2, max_tot_bw_pk=3,
+                       action=Action.BLOCK)
+    fw2 = FirewallRule(protocol="UDP", dst_port=53, action=Action.ALLOW)
+    fw3 = FirewallRule(protocol="TCP", dst_port=22, min_tot_fw_pk=100, max_tot_fw_pk=200, action=Action.BLOCK)
+    # overlaps fw1, as critical rules commonly overlap generated ones: it cannot share fw1's map
+    fw4 = FirewallRule(protocol="TCP", dst_port=80, min_tot_fw_pk=5, max_tot_fw_pk=10, action=Action.ALLOW)
+    key1, key2, key3, key4 = (fw_writer.rule_key(rule) for rule in (fw1, fw2, fw3, fw4))
+    # the first synchronization creates the table, its chain and a first map holding the rules
+    assert fw_writer.sync_rules([fw1, fw2]) == (2, 0)
+    [created] = fw_writer.rendered_scripts
+    assert created.startswith("table inet fw_ips {}\ndelete table inet fw_ips\n"), created
+    assert "type filter hook forward priority filter; policy accept;" in created, created
+    assert created.count("add map inet fw_ips ") == 1 and "add map inet fw_ips TEST_rules_0 {" in created, created
+    assert "add rule inet fw_ips TEST meta l4proto . th dport . ct bytes . ct packets . ct original packets . " \
+           "ct reply packets vmap @TEST_rules_0" in created, created
+    assert f"add element inet fw_ips TEST_rules_0 {{ {key1}, {key2} }}" in created, created
+    # later synchronizations only apply the difference, and a rule overlapping fw1 opens a second map, which is
+    # looked up after the first one
+    assert fw_writer.sync_rules([fw1, fw3, fw4]) == (2, 1)
+    assert len(fw_writer.rendered_scripts) == 2
+    applied = fw_writer.rendered_scripts[1].splitlines()
+    assert applied == [
+        f"delete element inet fw_ips TEST_rules_0 {{ {key2.rsplit(' : ', 1)[0]} }}",
+        "add map inet fw_ips TEST_rules_1 { typeof meta l4proto . th dport . ct bytes . ct packets . "
+        "ct original packets . ct reply packets : verdict; flags interval; }",
+        "add rule inet fw_ips TEST meta l4proto . th dport . ct bytes . ct packets . ct original packets . "
+        "ct reply packets vmap @TEST_rules_1",
+        f"add element inet fw_ips TEST_rules_0 {{ {key3} }}",
+        f"add element inet fw_ips TEST_rules_1 {{ {key4} }}",
+    ], applied
+    # bounds are widened to whole numbers, so the rule still matches every flow it did
+    assert key1 == "tcp . 80 . 950-1051 . 9-11 . 4-6 . 2-3 : goto reject_flow", key1
+    layers = fw_writer._get_layers()
+    assert [list(elements) for elements in layers] == [[key1, key3], [key4]], layers
+    # overlapping rules written at once are spread over layers as well, the first one written taking precedence
+    script = fw_writer.render_ruleset([fw4, fw1, fw3])
+    assert f"add element inet fw_ips TEST_rules_0 {{ {key4}, {key3} }}" in script, script
+    assert f"add element inet fw_ips TEST_rules_1 {{ {key1} }}" in script, script
+    # rules read back from `nft list table` are the same firewall rules, in priority order
+    listing = f"table inet fw_ips {{\n\tmap TEST_rules_0 {{\n\t\ttypeof {NFTablesWriter._key} : verdict\n" \
+              f"\t\tflags interval\n\t\telements = {{ {fw_writer.rule_key(fw1)},\n\t\t\t" \
+              f"{fw_writer.rule_key(fw3)} }}\n\t}}\n\n\tmap TEST_rules_1 {{\n\t\ttypeof {NFTablesWriter._key} : " \
+              f"verdict\n\t\tflags interval\n\t\telements = {{ {fw_writer.rule_key(fw4)} }}\n\t}}\n\n" \
+              f"\tchain reject_flow {{\n\t\treject\n\t}}\n}}"
+    assert [list(elements) for elements in fw_writer._read_nft_layers(listing)] == \
+           [list(elements) for elements in layers]
+    print('ok')
@@ -0,0 +1,75 @@
+import itertools
+import random
+
+import numpy as np
+
+from src.ai_module.utils.rule_compaction import compact_rules, INTEGER_DIMENSIONS
+from src.models.fingerprint import RANGE_FIELDS
+from src.models.enums import Action
+from src.models.firewall_rule import FirewallRule
+
+
+def bounds(rule: FirewallRule) -> np.ndarray:
+    return np.array([(getattr(rule, min_field), getattr(rule, max_field)) for min_field, max_field in RANGE_FIELDS],
+                    dtype=float)
+
+
+def covered_space(box: np.ndarray, sources: list[np.ndarray]) -> tuple[float, float]:
+    """
+    Exact space covered by a merged box and by the union of its sources, measured over the dimensions the merged box
+    spans: integer bounds are made half-open, so every range becomes [lower, upper).
+    """
+    spans = [integer or box[d, 1] > box[d, 0] for d, integer in enumerate(INTEGER_DIMENSIONS)]
+    dims = [d for d in range(len(spans)) if spans[d]]
+    half_open = lambda b: [(b[d, 0], b[d, 1] + INTEGER_DIMENSIONS[d]) for d in dims]
+    sources = [half_open(source) for source in sources]
+    axes = [sorted({bound for source in sources for bound in source[i]}) for i in range(len(dims))]
+    union = 0.
+    for cell in itertools.product(*[range(len(axis) - 1) for axis in axes]):
+        cell = [(axes[i][j], axes[i][j + 1]) for i, j in enumerate(cell)]
+        if any(all(lo <= c_lo and c_hi <= hi for (lo, hi), (c_lo, c_hi) in zip(source, cell)) for source in sources):
+            union += np.prod([c_hi - c_lo for c_lo, c_hi in cell])
+    return float(np.prod([hi - lo for lo, hi in half_open(box)])), union
+
+
+def check(rules: list[FirewallRule], max_widening: float) -> list[tuple[FirewallRule, list[int]]]:
+    compacted = compact_rules(rules, max_widening=max_widening)
+    assert sorted(m for _, members in compacted for m in members) == list(range(len(rules)))
+    for rule, members in compacted:
+        box, sources = bounds(rule), [bounds(rules[m]) for m in members]
+        assert all((box[:, 0] <= source[:, 0]).all() and (source[:, 1] <= box[:, 1]).all() for source in sources)
+        # the points the merged rule admits outside every source are at most max_widening of what the sources cover
+        volume, union = covered_space(box, sources)
+        assert volume <= (1 + max_widening) * union * (1 + 1e-9), (members, volume, union)
+    return compacted
+
+
+def rule(fl_byt_s, fl_pkt_s, tot_fw_pk, tot_bw_pk) -> FirewallRule:
+    return FirewallRule(protocol='tcp', dst_port=80, action=Action.BLOCK,
+                        min_fl_byt_s=fl_byt_s[0], max_fl_byt_s=fl_byt_s[1], min_fl_pkt_s=fl_pkt_s[0],
+                        max_fl_pkt_s=fl_pkt_s[1], min_tot_fw_pk=tot_fw_pk[0], max_tot_fw_pk=tot_fw_pk[1],
+                        min_tot_bw_pk=tot_bw_pk[0], max_tot_bw_pk=tot_bw_pk[1])
+
+
+if __name__ == '__main__':
+    # distant flow packets/s ranges are neither adjacent nor within the widening, so they stay apart
+    compacted = check([rule((100, 200), (0.0095, 0.0105), (1, 2), (1, 2)),
+                       rule((100, 200), (0.94, 0.94), (1, 2), (1, 2))], max_widening=0.1)
+    assert len(compacted) == 2, compacted
+    # touching float ranges and adjacent integer ranges merge without widening
+    compacted = check([rule((100, 200), (1.5, 2.5), (1, 2), (1, 2)),
+                       rule((100, 200), (2.5, 3.5), (1, 2), (1, 2)),
+                       rule((100, 200), (1.5, 3.5), (3, 4), (1, 2))], max_widening=0.)
+    assert len(compacted) == 1, compacted
+    # a chain of small merges must not creep past the widening of the original rules
+    check([rule((0, 10), (0, 10), (i, i), (0, 10 - i)) for i in range(11)], max_widening=0.1)
+    random.seed(0)
+    for _ in range(200):
+        rules = []
+        for _ in range(random.randint(2, 8)):
+            lower = [random.uniform(0, 10), random.uniform(0, 10), random.randint(0, 10), random.randint(0, 10)]
+            upper = [lower[0] + random.choice([0, random.uniform(0, 5)]), lower[1] + random.uniform(0, 5),
+                     lower[2] + random.randint(0, 5), lower[3] + random.randint(0, 5)]
+            rules.append(rule(*zip(lower, upper)))
+        check(rules, max_widening=random.choice([0., 0.1, 0.5]))
+    print('ok')
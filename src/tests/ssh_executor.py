@@ -0,0 +1,110 @@
+import os
+import stat
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.services.executor import SSHExecutor
+
+# stand-in for ssh that logs its arguments. Its state lives in files of $FAKE_SSH_DIR: 'master-dead' makes
+# `-O check` report the master connection as down, 'fail-once' makes the next command exit with 255, and every
+# command running at once holds a file in running/, whose peak count is kept in 'max-running'
+FAKE_SSH = f'''#!{sys.executable}
+import os, sys, time
+from pathlib import Path
+
+state = Path(os.environ['FAKE_SSH_DIR'])
+with open(state / 'calls', 'a') as calls:
+    calls.write(repr(sys.argv[1:]) + '\\n')
+if '-O' in sys.argv:
+    operation = sys.argv[sys.argv.index('-O') + 1]
+    sys.exit(255 if operation == 'check' and (state / 'master-dead').exists() else 0)
+command = sys.argv[-1]
+if command == 'exit 255':
+    sys.exit(255)
+if command == 'fail once' and (state / 'fail-once').exists():
+    (state / 'fail-once').unlink()
+    sys.exit(255)
+if command == 'sleep':
+    running = state / 'running' / str(os.getpid())
+    running.touch()
+    count = len(list((state / 'running').iterdir()))
+    with open(state / 'max-running', 'a') as peaks:
+        peaks.write(f'{{count}}\\n')
+    time.sleep(0.2)
+    running.unlink()
+print(command)
+'''
+
+
+def read_calls(state: Path) -> list[list[str]]:
+    calls = state / 'calls'
+    calls = [eval(line) for line in calls.read_text().splitlines()] if calls.exists() else []
+    (state / 'calls').unlink(missing_ok=True)
+    return calls
+
+
+if __name__ == '__main__':
+    state = Path(tempfile.mkdtemp())
+    (state / 'bin').mkdir()
+    (state / 'running').mkdir()
+    fake_ssh = state / 'bin' / 'ssh'
+    fake_ssh.write_text(FAKE_SSH)
+    fake_ssh.chmod(0o755)
+    os.environ['PATH'] = f"{state / 'bin'}{os.pathsep}{os.environ['PATH']}"
+    os.environ['FAKE_SSH_DIR'] = str(state)
+    runtime_dir = state / 'runtime'
+    runtime_dir.mkdir()
+    os.environ['XDG_RUNTIME_DIR'] = str(runtime_dir)
+
+    # commands are multiplexed over a master connection whose socket lives in a directory private to this user
+    executor = SSHExecutor('firewall.local', 'admin', '/keys/id', control_persist_seconds=30, max_concurrent_commands=2)
+    control_dir = runtime_dir / 'fw-ips-ssh'
+    assert stat.S_IMODE(os.lstat(control_dir).st_mode) == 0o700
+    assert executor.execute('echo hi') == 'echo hi\n'
+    [call] = read_calls(state)
+    assert call[:3] == ['-i', '/keys/id', '-o'] and call[-2:] == ['admin@firewall.local', 'echo hi'], call
+    options = dict(option.split('=', 1) for option in call[3:-2:2])
+    assert options == {'ControlMaster': 'auto', 'ControlPath': str(control_dir / '%C'), 'ControlPersist': '30'}, \
+        options
+    # a control directory others can reach is refused
+    control_dir.chmod(0o755)
+    try:
+        SSHExecutor('firewall.local', 'admin', '/keys/id')
+        raise AssertionError('a control directory open to others was accepted')
+    except RuntimeError:
+        pass
+    control_dir.chmod(0o700)
+
+    # a command exiting with 255 while the master is alive failed by itself, and is not run again
+    try:
+        executor.execute('exit 255')
+        raise AssertionError('exit code 255 was not reported')
+    except RuntimeError:
+        pass
+    calls = read_calls(state)
+    assert [call[-1] for call in calls] == ['exit 255', 'admin@firewall.local'], calls
+    assert calls[1][-3:-1] == ['-O', 'check'], calls
+    # once the master is found dead, it is closed and the command runs once more over a new connection
+    (state / 'master-dead').touch()
+    (state / 'fail-once').touch()
+    assert executor.execute('fail once') == 'fail once\n'
+    calls = read_calls(state)
+    assert [call[-3:] for call in calls[1:3]] == [['-O', 'check', 'admin@firewall.local'],
+                                                  ['-O', 'exit', 'admin@firewall.local']], calls
+    assert [call[-1] for call in calls] == ['fail once', 'admin@firewall.local', 'admin@firewall.local', 'fail once']
+    # a command that keeps failing is reported after the single retry
+    try:
+        executor.execute('exit 255')
+        raise AssertionError('exit code 255 was not reported')
+    except RuntimeError:
+        pass
+    assert [call[-1] for call in read_calls(state)].count('exit 255') == 2
+
+    # no more than max_concurrent_commands ssh processes run at once
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(executor.execute, ['sleep'] * 8)) == ['sleep\n'] * 8
+    peaks = [int(peak) for peak in (state / 'max-running').read_text().split()]
+    assert len(peaks) == 8 and max(peaks) == 2, peaks
+    print('ok')